@@ -0,0 +1,75 @@
+"""
+Import-time benchmark for the combine_gtfs_feeds command line interface.
+
+Runs 'combine_gtfs_feeds --version' in fresh interpreters, reports the
+median wall time and exits with an error if it is over budget or if
+building the parser imports any heavy dependency.
+
+    python benchmarks/import_time.py [--runs N] [--budget SECONDS]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+heavy_modules = ["pandas", "numpy", "pandera", "yaml", "duckdb"]
+
+cli_code = (
+    "import sys\n"
+    "sys.argv = ['combine_gtfs_feeds', 'run', '--help']\n"
+    "from combine_gtfs_feeds.cli.main import main\n"
+    "try:\n"
+    "    main()\n"
+    "except SystemExit:\n"
+    "    pass\n"
+    "print('loaded:' + ','.join(m for m in {modules} if m in sys.modules))\n"
+)
+
+version_code = (
+    "import sys\n"
+    "sys.argv = ['combine_gtfs_feeds', '--version']\n"
+    "from combine_gtfs_feeds.cli.main import main\n"
+    "main()\n"
+)
+
+
+def run_python(code):
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).resolve().parents[1],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.5, metavar="SECONDS")
+    args = parser.parse_args()
+
+    result = run_python(cli_code.format(modules=heavy_modules))
+    loaded = result.stdout.strip().splitlines()[-1].replace("loaded:", "")
+    loaded = [m for m in loaded.split(",") if m]
+
+    times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        run_python(version_code)
+        times.append(time.perf_counter() - start)
+    median = statistics.median(times)
+
+    print(f"--version median: {median:.3f}s over {args.runs} runs")
+    print(f"heavy modules imported by the parser: {loaded or 'none'}")
+
+    if loaded or median > args.budget:
+        print(f"FAILED (budget {args.budget:.3f}s, no heavy modules)")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,15 @@
+import importlib
+
 from .cli import CLI
-from .gtfs_schema import GTFS_Schema
-from . import run
+
+
+def __getattr__(name):
+    # run, gtfs_schema and diff import pandas, numpy and pandera, so
+    # they are only loaded when first used
+    if name == "run":
+        return importlib.import_module(".run", __name__)
+    if name == "GTFS_Schema":
+        return importlib.import_module(".gtfs_schema", __name__).GTFS_Schema
+    if name == "diff_feeds":
+        return importlib.import_module(".diff", __name__).diff_feeds
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
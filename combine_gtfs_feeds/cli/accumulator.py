@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import re
+import shutil
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+memory_units = {
+    "": 1,
+    "B": 1,
+    "KB": 1000,
+    "MB": 1000**2,
+    "GB": 1000**3,
+    "TB": 1000**4,
+    "KIB": 1024,
+    "MIB": 1024**2,
+    "GIB": 1024**3,
+    "TIB": 1024**4,
+}
+
+
+def parse_memory_limit(value: str) -> int:
+    """
+    Converts a memory size such as '8GB' or '500MiB' to a number
+    of bytes.
+    """
+
+    match = re.fullmatch(r"\s*([\d.]+)\s*([A-Za-z]*)\s*", str(value))
+    if not match or match.group(2).upper() not in memory_units:
+        raise ValueError(f"Invalid memory size: {value}")
+    return int(float(match.group(1)) * memory_units[match.group(2).upper()])
+
+
+def union_categories(frames: list) -> None:
+    """
+    Gives categorical columns the same categories in every frame, so
+    they stay categorical when the frames are concatenated.
+    """
+
+    columns = {}
+    for frame in frames:
+        for name, dtype in frame.dtypes.items():
+            columns.setdefault(name, []).append(isinstance(dtype, pd.CategoricalDtype))
+    for name, is_categorical in columns.items():
+        if not all(is_categorical) or len(is_categorical) < 2:
+            continue
+        categories = union_categoricals(
+            [frame[name] for frame in frames if name in frame.columns]
+        ).categories
+        for frame in frames:
+            if name in frame.columns:
+                frame[name] = frame[name].cat.set_categories(categories)
+
+
+class Feed_Accumulator:
+    """
+    Collects the processed tables of each feed and builds each combined
+    table with a single concat. If the tables held in memory exceed
+    memory_limit (bytes), the feeds collected so far are spilled to
+    temporary files in spill_dir (default: the system temp dir) and
+    read back one table at a time when the combined tables are built.
+    """
+
+    def __init__(self, file_list: list, memory_limit=None, spill_dir=None, logger=None):
+        self.file_list = file_list
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        self.logger = logger
+        # per table list of DataFrames, or paths to spilled DataFrames
+        self.parts = {file_name: [] for file_name in file_list}
+        self.memory_usage = 0
+        self.feed_count = 0
+        self.temp_dir = None
+
+    def __len__(self):
+        return self.feed_count
+
+    def add(self, feed: str, feed_tables: dict) -> None:
+        """
+        Adds the tables of a processed feed. The tables are removed from
+        feed_tables so the accumulator holds the only reference to them.
+        Their memory use is only measured if there is a memory_limit.
+        """
+
+        for file_name in self.file_list:
+            df = feed_tables.pop(file_name)
+            self.parts[file_name].append(df)
+            if self.memory_limit is not None:
+                self.memory_usage += int(df.memory_usage(deep=True).sum())
+        self.feed_count += 1
+
+        if self.memory_limit is not None and self.memory_usage > self.memory_limit:
+            self.spill()
+
+    def spill(self) -> None:
+        """
+        Writes the tables held in memory to temporary files.
+        """
+
+        if self.temp_dir is None:
+            self.temp_dir = Path(
+                tempfile.mkdtemp(prefix="combine_gtfs_", dir=self.spill_dir)
+            )
+        if self.logger:
+            self.logger.info(
+                "Memory limit reached, writing {} MB of combined tables to {}".format(
+                    round(self.memory_usage / 1000**2), self.temp_dir
+                )
+            )
+        for file_name, parts in self.parts.items():
+            for i, part in enumerate(parts):
+                if isinstance(part, pd.DataFrame):
+                    path = self.temp_dir / f"{file_name}_{i}.pkl"
+                    part.to_pickle(path)
+                    parts[i] = path
+        self.memory_usage = 0
+
+    def concat(self, file_name: str) -> pd.DataFrame:
+        """
+        Returns the combined table for file_name and releases the
+        per-feed tables it was built from.
+        """
+
+        parts = self.parts.pop(file_name)
+        frames = [
+            pd.read_pickle(part) if isinstance(part, Path) else part for part in parts
+        ]
+        del parts
+        if len(frames) == 0:
+            return pd.DataFrame()
+        union_categories(frames)
+        return pd.concat(frames)
+
+    def cleanup(self) -> None:
+        """
+        Removes any spilled files.
+        """
+
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
@@ -0,0 +1,338 @@
+"""
+Command line arguments for each sub-command. Kept free of pandas, numpy
+and pandera imports so that building the parser, --help and --version
+stay fast.
+"""
+
+import os as os
+
+run_description = (
+    "Implements the 'run' sub-command, which combines gtfs files from each feed"
+    " and writes them out to a single feed."
+)
+
+
+def add_run_args(parser, multiprocess=True):
+    """
+    Run command args
+    """
+    parser.add_argument(
+        "-g",
+        "--gtfs_dir",
+        type=str,
+        metavar="PATH",
+        help="path to GTFS dir (default: %s)" % os.getcwd(),
+    )
+
+    parser.add_argument(
+        "-s",
+        "--service_date",
+        type=int,
+        metavar="SERVICEDATE",
+        help=(
+            "date for service in yyyymmdd integer format                      "
+            " (default: %s)"
+        )
+        % os.getcwd(),
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        metavar="PATH",
+        help="path to ourput directory (default: %s)" % os.getcwd(),
+    )
+
+    parser.add_argument(
+        "--prefetch_depth",
+        type=int,
+        default=2,
+        metavar="N",
+        help=(
+            "number of feeds read ahead on background threads while the"
+            " current feed is processed, 0 reads feeds sequentially (default: 2)"
+        ),
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=["pandas", "duckdb"],
+        default="pandas",
+        help=(
+            "pandas combines feeds in memory, duckdb runs the same steps in an"
+            " embedded database that can spill to disk (default: pandas)"
+        ),
+    )
+
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        metavar="PATH",
+        help=(
+            "directory for temporary files, such as the duckdb database and"
+            " feeds spilled to disk (default: system temp dir)"
+        ),
+    )
+
+    parser.add_argument(
+        "--memory_limit",
+        type=str,
+        metavar="SIZE",
+        help=(
+            "memory to use for combined tables, e.g. 8GB. Processed feeds over"
+            " this limit are spilled to work_dir (default: no limit)"
+        ),
+    )
+
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help=(
+            "also write route_stats.csv (trips, first and last trip and"
+            " headways by period per route) and stop_stats.csv (trips, routes"
+            " and first and last departure per stop) to output_dir"
+        ),
+    )
+
+    parser.add_argument(
+        "--sorted_output",
+        action="store_true",
+        help=(
+            "sort stop_times by trip_id and stop_sequence and shapes by shape_id"
+            " and shape_pt_sequence, and write stop_times_index.csv and"
+            " shapes_index.csv with the rows and byte range of each trip/shape"
+        ),
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help=(
+            "save the processed feeds, the merged tables and the validated"
+            " tables to combine_checkpoint in work_dir (or output_dir) so a"
+            " failed run can be resumed. Removed after a successful run"
+        ),
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "continue a failed --checkpoint run from its last completed stage."
+            " Starts from the beginning if the checkpoint is missing or was"
+            " made with other parameters. Feeds added, removed or changed since"
+            " are read again and the merge and validation are run again"
+        ),
+    )
+
+    parser.add_argument(
+        "--orphans",
+        choices=["keep", "drop"],
+        default="keep",
+        help=(
+            "keep or drop rows that reference missing ids, e.g. stop_times of"
+            " a missing stop. Orphans are listed in integrity_report.csv"
+            " either way (default: keep)"
+        ),
+    )
+
+    parser.add_argument(
+        "--optimize_dtypes",
+        action="store_true",
+        help=(
+            "downcast numbers and store repeated text as categoricals after"
+            " reading each feed to reduce memory use. Output is unchanged"
+        ),
+    )
+
+    parser.add_argument(
+        "--start_time",
+        type=str,
+        metavar="HH:MM:SS",
+        help="only keep trips from this time of day on (default: 00:00:00)",
+    )
+
+    parser.add_argument(
+        "--end_time",
+        type=str,
+        metavar="HH:MM:SS",
+        help=(
+            "only keep trips before this time of day, after 24:00:00 for a"
+            " window that runs past midnight (default: no limit)"
+        ),
+    )
+
+    parser.add_argument(
+        "--time_rule",
+        choices=["starts", "touches"],
+        default="starts",
+        help=(
+            "keep trips that start in the start_time/end_time window or trips"
+            " that are running at any time in the window (default: starts)"
+        ),
+    )
+
+    parser.add_argument(
+        "--agencies",
+        type=str,
+        nargs="+",
+        metavar="AGENCY",
+        help="only keep routes of these agencies, by agency_id or agency_name",
+    )
+
+    parser.add_argument(
+        "--route_types",
+        type=int,
+        nargs="+",
+        metavar="ROUTE_TYPE",
+        help="only keep routes of these route_types, e.g. 0 1 2 for rail",
+    )
+
+    parser.add_argument(
+        "--routes",
+        type=str,
+        nargs="+",
+        metavar="ROUTE_ID",
+        help="only keep these routes, by route_id or combined (feed_route_id) id",
+    )
+
+
+batch_description = (
+    "Implements the 'batch' sub-command, which runs the combine jobs listed in a"
+    " YAML manifest, parsing each feed once for all the jobs that use it."
+)
+
+
+def add_batch_args(parser, multiprocess=True):
+    """
+    Batch command args
+    """
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        type=str,
+        required=True,
+        metavar="PATH",
+        help=(
+            "YAML manifest with a list of jobs, each with the gtfs_dir,"
+            " service_date and output_dir of a run and optionally feeds and"
+            " any other run setting. Settings under defaults apply to every job"
+        ),
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        metavar="N",
+        help="number of jobs run at the same time (default: workers in manifest or 1)",
+    )
+
+    parser.add_argument(
+        "--summary_csv",
+        type=str,
+        metavar="PATH",
+        help=(
+            "csv file for the status and time of each job (default: summary_csv"
+            " in manifest or <manifest>_summary.csv)"
+        ),
+    )
+
+
+watch_description = (
+    "Implements the 'watch' sub-command, which combines gtfs files from each feed"
+    " and combines them again whenever feeds in gtfs_dir are added, changed or"
+    " removed."
+)
+
+
+def add_watch_args(parser, multiprocess=True):
+    """
+    Watch command args
+    """
+    add_run_args(parser, multiprocess)
+
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        metavar="SECONDS",
+        help="seconds between checks of gtfs_dir for changed feeds (default: 10)",
+    )
+
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=30,
+        metavar="SECONDS",
+        help=(
+            "seconds without further changes before a rebuild starts, so a"
+            " feed that is still being written is not read (default: 30)"
+        ),
+    )
+
+
+diff_description = (
+    "Implements the 'diff' sub-command, which compares two combined feeds table"
+    " by table and writes a summary and a list of the changes."
+)
+
+
+def add_diff_args(parser, multiprocess=True):
+    """
+    Diff command args
+    """
+    parser.add_argument(
+        "--old_dir",
+        type=str,
+        required=True,
+        metavar="PATH",
+        help="path to the combined feed to compare from",
+    )
+
+    parser.add_argument(
+        "--new_dir",
+        type=str,
+        required=True,
+        metavar="PATH",
+        help="path to the combined feed to compare to",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        default=os.getcwd(),
+        metavar="PATH",
+        help=(
+            "path to the directory for diff_summary.csv and diff_changes.csv"
+            " (default: %s)" % os.getcwd()
+        ),
+    )
+
+    parser.add_argument(
+        "--tables",
+        type=str,
+        nargs="+",
+        metavar="TABLE",
+        help="only compare these tables, e.g. trips stop_times (default: all)",
+    )
+
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1000000,
+        metavar="ROWS",
+        help="rows read at a time, bounds memory use (default: 1000000)",
+    )
+
+    parser.add_argument(
+        "--max_details",
+        type=int,
+        default=100000,
+        metavar="N",
+        help=(
+            "list the changed columns for up to this many changed trips, stops,"
+            " etc. per table (default: 100000)"
+        ),
+    )
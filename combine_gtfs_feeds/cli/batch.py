@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import combine_gtfs_feeds.cli.log_controller as log_controller  # type: ignore
+
+try:
+    from .run import (
+        combine,
+        filter_feed,
+        filter_rows,
+        get_feed_list,
+        get_route_filter,
+        get_time_window,
+        read_feed,
+    )
+    from .summary import service_summary
+except Exception:
+    from run import (
+        combine,
+        filter_feed,
+        filter_rows,
+        get_feed_list,
+        get_route_filter,
+        get_time_window,
+        read_feed,
+    )
+    from summary import service_summary
+
+import argparse
+import logging
+import os as os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+# manifest job settings and their defaults, the same as the run arguments
+job_settings = {
+    "name": None,
+    "gtfs_dir": None,
+    "feeds": None,
+    "service_date": None,
+    "output_dir": None,
+    "start_time": None,
+    "end_time": None,
+    "time_rule": "starts",
+    "agencies": None,
+    "route_types": None,
+    "routes": None,
+    "orphans": "keep",
+    "optimize_dtypes": False,
+    "summary": False,
+    "sorted_output": False,
+    "prefetch_depth": 2,
+    "memory_limit": None,
+    "work_dir": None,
+}
+
+required_settings = ["name", "gtfs_dir", "service_date", "output_dir"]
+
+path_settings = ["gtfs_dir", "output_dir", "work_dir"]
+
+summary_columns = ["job", "status", "feeds", "seconds", "output_dir", "message"]
+
+
+class Job_Logger(logging.LoggerAdapter):
+    """
+    Prefixes each message with the job name, as jobs share a log.
+    """
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['job']}] {msg}", kwargs
+
+
+class Feed_Cache:
+    """
+    Parses each feed once for all the jobs of a batch. uses counts the
+    jobs that read each feed, keyed by feed_key; a feed is dropped from
+    the cache once the last of them has read it. Each job gets its own
+    copy of the tables, with its route filter applied in memory.
+    """
+
+    def __init__(self, uses: Counter):
+        self.uses = uses
+        self.tables = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def read(
+        self,
+        path: Path,
+        is_zipped: bool,
+        feed_name: str,
+        logger: log_controller.logging.Logger,
+        route_filter=None,
+        optimize=False,
+    ) -> dict:
+        """
+        Returns the tables of a feed like read_feed, parsing the feed
+        only if it is not in the cache.
+        """
+
+        key = feed_key(path, optimize)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                if key not in self.tables:
+                    self.tables[key] = read_feed(
+                        path, is_zipped, feed_name, logger, None, optimize
+                    )
+                tables = self.tables[key]
+        finally:
+            self.release(key)
+
+        if route_filter is None:
+            feed_tables = {name: df.copy() for name, df in tables.items()}
+        else:
+            feed_tables = {
+                "calendar": tables["calendar"].copy(),
+                "calendar_dates": tables["calendar_dates"].copy(),
+            }
+            feed_tables.update(
+                filter_feed(
+                    lambda file_name, row_filter=None: filter_rows(
+                        tables[file_name], row_filter
+                    ).copy(),
+                    feed_name,
+                    route_filter,
+                )
+            )
+        return feed_tables
+
+    def release(self, key: tuple) -> None:
+        """
+        Records that a job is done with a feed and drops the feed from
+        the cache if no other job needs it.
+        """
+
+        with self.lock:
+            self.uses[key] -= 1
+            if self.uses[key] <= 0:
+                self.tables.pop(key, None)
+                self.locks.pop(key, None)
+
+
+def feed_key(path: Path, optimize: bool) -> tuple:
+    return str(Path(path).resolve()), optimize
+
+
+def load_manifest(manifest_path: Path) -> tuple[list, dict]:
+    """
+    Reads a batch manifest and returns a list of job settings, with
+    the manifest defaults filled in and relative paths resolved against
+    the manifest's directory, and the batch settings.
+    """
+
+    with open(manifest_path) as f:
+        manifest = yaml.safe_load(f) or {}
+    base_dir = manifest_path.parent
+    defaults = manifest.get("defaults") or {}
+    jobs = []
+    for i, job in enumerate(manifest.get("jobs") or []):
+        settings = {**job_settings, **defaults, **job}
+        settings["name"] = str(settings["name"] or f"job_{i + 1}")
+        unknown = [key for key in settings if key not in job_settings]
+        if unknown:
+            raise ValueError(
+                f"Unknown setting(s) {', '.join(unknown)} for job {settings['name']}"
+            )
+        missing = [key for key in required_settings if settings[key] is None]
+        if missing:
+            raise ValueError(
+                f"Missing setting(s) {', '.join(missing)} for job {settings['name']}"
+            )
+        for key in path_settings:
+            if settings[key] is not None:
+                settings[key] = str(base_dir / settings[key])
+        jobs.append(settings)
+
+    names = [job["name"] for job in jobs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError(f"Duplicate job name(s) {', '.join(duplicates)}")
+    if "summary" in manifest:
+        raise ValueError(
+            "summary is a job setting, use summary_csv for the path of the"
+            " batch summary"
+        )
+    summary_csv = manifest.get("summary_csv")
+    if summary_csv is not None and not isinstance(summary_csv, str):
+        raise ValueError(f"summary_csv must be a path, not {summary_csv!r}")
+    if summary_csv is not None:
+        summary_csv = str(base_dir / summary_csv)
+    batch_settings = {
+        "workers": manifest.get("workers", 1),
+        "summary_csv": summary_csv,
+    }
+    return jobs, batch_settings
+
+
+def job_feed_keys(job: dict) -> list:
+    """
+    Returns the cache keys of the feeds a job reads.
+    """
+
+    gtfs_dir = Path(job["gtfs_dir"])
+    if not os.path.isdir(gtfs_dir):
+        return []
+    feed_list, _ = get_feed_list(gtfs_dir)
+    if job["feeds"] is not None:
+        feed_list = [feed for feed in feed_list if feed in job["feeds"]]
+    return [feed_key(gtfs_dir / feed, job["optimize_dtypes"]) for feed in feed_list]
+
+
+def run_job(job: dict, cache: Feed_Cache, logger) -> dict:
+    """
+    Combines the feeds of a job and exports them to its output_dir.
+    Returns the job's row of the batch summary.
+    """
+
+    job_logger = Job_Logger(logger, {"job": job["name"]})
+    keys = job_feed_keys(job)
+    read = []
+
+    def feed_reader(path, is_zipped, feed_name, logger, route_filter, optimize):
+        read.append(feed_key(path, optimize))
+        return cache.read(path, is_zipped, feed_name, logger, route_filter, optimize)
+
+    start = time.perf_counter()
+    status, message = "done", ""
+    try:
+        os.makedirs(job["output_dir"], exist_ok=True)
+        feeds = combine(
+            job["gtfs_dir"],
+            job["service_date"],
+            job["output_dir"],
+            job_logger,
+            prefetch_depth=job["prefetch_depth"],
+            time_window=get_time_window(
+                job["start_time"], job["end_time"], job["time_rule"]
+            ),
+            route_filter=get_route_filter(
+                job["agencies"], job["route_types"], job["routes"]
+            ),
+            memory_limit=job["memory_limit"],
+            work_dir=job["work_dir"],
+            orphans=job["orphans"],
+            optimize=job["optimize_dtypes"],
+            feeds=job["feeds"],
+            feed_reader=feed_reader,
+        )
+        if job["summary"]:
+            feeds.summary_tables = service_summary(
+                feeds.trips_df, feeds.stop_times_df, feeds.routes_df, feeds.stops_df
+            )
+        feeds.export_feed(job["sorted_output"])
+    except SystemExit:
+        status, message = "failed", "exited early, see run_log.txt"
+    except Exception as e:
+        status, message = "failed", f"{type(e).__name__}: {str(e).splitlines()[0]}"
+    finally:
+        # release the feeds the job did not get to
+        for key in read:
+            if key in keys:
+                keys.remove(key)
+        for key in keys:
+            cache.release(key)
+
+    seconds = round(time.perf_counter() - start, 1)
+    job_logger.info(f"Job {status} in {seconds} seconds {message}".rstrip())
+    return {
+        "job": job["name"],
+        "status": status,
+        "feeds": len(read),
+        "seconds": seconds,
+        "output_dir": job["output_dir"],
+        "message": message,
+    }
+
+
+def batch(args: argparse.Namespace) -> None:
+    """
+    Implements the 'batch' sub-command, which runs the combine jobs
+    listed in a manifest. Jobs that read the same feeds are run next to
+    each other and share one parse of each feed.
+    """
+
+    manifest_path = Path(args.manifest).resolve()
+    try:
+        jobs, batch_settings = load_manifest(manifest_path)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        print("Invalid manifest {}: {}".format(manifest_path, e))
+        print("Exiting application early!")
+        sys.exit()
+    workers = args.workers or batch_settings["workers"]
+    # a summary_csv from the command line is relative to the current
+    # directory, load_manifest resolves one from the manifest
+    summary_path = args.summary_csv or batch_settings["summary_csv"]
+    if summary_path is None:
+        summary_path = manifest_path.with_name(manifest_path.stem + "_summary.csv")
+    summary_path = Path(summary_path).resolve()
+
+    logger = log_controller.setup_custom_logger("main_logger", summary_path.parent)
+    logger.info("------------------combine_gtfs_feeds batch Started----------------")
+    logger.info(f"Running {len(jobs)} jobs from {manifest_path} on {workers} workers")
+
+    # group jobs by the feeds they read, so a feed is parsed once and
+    # released soon after
+    job_keys = {job["name"]: job_feed_keys(job) for job in jobs}
+    jobs = sorted(jobs, key=lambda job: sorted(job_keys[job["name"]]))
+    uses = Counter(key for keys in job_keys.values() for key in keys)
+    logger.info(
+        f"{len(uses)} feeds are read {sum(uses.values())} times by the jobs"
+        " and parsed once each"
+    )
+    cache = Feed_Cache(uses)
+
+    with ThreadPoolExecutor(
+        max_workers=max(workers, 1), thread_name_prefix="gtfs_batch"
+    ) as executor:
+        rows = list(executor.map(lambda job: run_job(job, cache, logger), jobs))
+
+    summary = pd.DataFrame(rows, columns=summary_columns)
+    summary.to_csv(summary_path, index=None)
+    failed = summary[summary["status"] == "failed"]
+    logger.info(
+        f"Finished {len(summary) - len(failed)} of {len(summary)} jobs, summary"
+        f" written to {summary_path}"
+    )
+    sys.exit(1 if len(failed) > 0 else None)
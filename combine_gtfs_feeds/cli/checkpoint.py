@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import json
+import pickle
+import shutil
+from pathlib import Path
+
+state_file = "state.json"
+
+
+def feed_signature(path: Path, is_zipped: bool) -> list:
+    """
+    Returns the size and modification time of a feed's zip file or of
+    each file in its folder, to tell if a feed changed since it was
+    checkpointed without reading it.
+    """
+
+    if is_zipped:
+        paths = [path.with_suffix(".zip")]
+    else:
+        paths = sorted(p for p in path.iterdir() if p.is_file())
+    return [[p.name, p.stat().st_size, p.stat().st_mtime_ns] for p in paths]
+
+
+class Checkpoint:
+    """
+    Saves the result of each stage of a combine to dir, so a failed run
+    can resume from the last completed stage. The stages are 'feeds',
+    checkpointed one processed feed at a time, 'merge', the combined
+    tables before validation, and 'validate', the validated tables.
+    Checkpoints are only used by a run with the same parameters;
+    otherwise dir is cleared. A stage saved with inputs, e.g. the feed
+    signatures, is run again if its inputs changed.
+    """
+
+    def __init__(self, dir, params: dict, resume=False, logger=None):
+        self.dir = Path(dir)
+        self.params = json.dumps(params, sort_keys=True, default=str)
+        self.logger = logger
+        self.state = None
+        if resume:
+            try:
+                with open(self.dir / state_file) as f:
+                    state = json.load(f)
+                if state["params"] == self.params:
+                    self.state = state
+                elif logger:
+                    logger.info(
+                        "Checkpoint in {} is from a run with other parameters,"
+                        " starting from the beginning".format(self.dir)
+                    )
+            except (OSError, ValueError, KeyError):
+                if logger:
+                    logger.info(
+                        "No checkpoint found in {}, starting from the beginning".format(
+                            self.dir
+                        )
+                    )
+        if self.state is None:
+            self.clear()
+            self.state = {
+                "params": self.params,
+                "completed": [],
+                "feeds": {},
+                "inputs": {},
+            }
+            self.dir.mkdir(parents=True, exist_ok=True)
+            self.write_state()
+        elif logger:
+            logger.info(
+                "Resuming from checkpoint in {}, completed stages: {}".format(
+                    self.dir, ", ".join(self.state["completed"]) or "none"
+                )
+            )
+
+    def write_state(self) -> None:
+        path = self.dir / state_file
+        with open(path.with_suffix(".tmp"), "w") as f:
+            json.dump(self.state, f)
+        path.with_suffix(".tmp").replace(path)
+
+    def write(self, name: str, obj) -> None:
+        path = self.dir / f"{name}.pkl"
+        with open(path.with_suffix(".tmp"), "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        path.with_suffix(".tmp").replace(path)
+
+    def read(self, name: str):
+        with open(self.dir / f"{name}.pkl", "rb") as f:
+            return pickle.load(f)
+
+    def done(self, stage: str, inputs=None) -> bool:
+        """
+        Returns True if stage was completed with the same inputs. A
+        stage completed with other inputs is marked not completed.
+        """
+
+        if stage not in self.state["completed"]:
+            return False
+        if self.state.setdefault("inputs", {}).get(stage) != inputs:
+            if self.logger:
+                self.logger.info(
+                    f"Inputs of stage {stage} changed since it was checkpointed,"
+                    " running it again"
+                )
+            self.state["completed"].remove(stage)
+            self.write_state()
+            return False
+        return True
+
+    def save(self, stage: str, obj, inputs=None) -> None:
+        """
+        Saves the result of a stage and marks it completed. inputs, if
+        given, must be JSON serializable (see done).
+        """
+
+        self.write(stage, obj)
+        if stage not in self.state["completed"]:
+            self.state["completed"].append(stage)
+        self.state.setdefault("inputs", {})[stage] = inputs
+        self.write_state()
+        if self.logger:
+            self.logger.info(f"Checkpointed stage {stage} in {self.dir}")
+
+    def load(self, stage: str):
+        if self.logger:
+            self.logger.info(f"Loading stage {stage} from checkpoint in {self.dir}")
+        return self.read(stage)
+
+    def has_feed(self, feed: str, signature: list) -> bool:
+        return self.state["feeds"].get(feed) == signature
+
+    def save_feed(self, feed: str, signature: list, tables, report) -> None:
+        """
+        Saves the processed tables and integrity report of a feed.
+        """
+
+        self.write(f"feed_{feed}", (tables, report))
+        self.state["feeds"][feed] = signature
+        self.write_state()
+
+    def load_feed(self, feed: str) -> tuple:
+        if self.logger:
+            self.logger.info(f"Loading feed {feed} from checkpoint in {self.dir}")
+        return self.read(f"feed_{feed}")
+
+    def clear(self) -> None:
+        """
+        Removes the checkpoint files.
+        """
+
+        shutil.rmtree(self.dir, ignore_errors=True)
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import combine_gtfs_feeds.cli.log_controller as log_controller  # type: ignore
+
+try:
+    from .export import feed_dir
+except Exception:
+    from export import feed_dir
+
+import argparse
+import os as os
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+# rows of each table are grouped into blocks by their key column and
+# compared block by block, e.g. all stop_times of a trip
+table_keys = {
+    "agency": "agency_id",
+    "routes": "route_id",
+    "stops": "stop_id",
+    "trips": "trip_id",
+    "stop_times": "trip_id",
+    "shapes": "shape_id",
+    "calendar": "service_id",
+}
+
+# columns that order the rows of a block, used to line rows up when
+# listing the columns that changed
+sequence_columns = {"stop_times": "stop_sequence", "shapes": "shape_pt_sequence"}
+
+summary_columns = [
+    "table",
+    "rows_old",
+    "rows_new",
+    "added",
+    "removed",
+    "changed",
+    "unchanged",
+    "columns_added",
+    "columns_removed",
+]
+
+change_columns = ["table", "key", "change", "rows_old", "rows_new", "columns"]
+
+
+def read_chunks(path: Path, chunksize: int):
+    """
+    Yields a csv file in chunks, with every value as the text written
+    to the file so that values compare the way they were serialized.
+    """
+
+    yield from pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize)
+
+
+def read_header(path: Path) -> list:
+    return list(pd.read_csv(path, dtype=str, nrows=0).columns)
+
+
+def hash_blocks(
+    path: Path, key: str, columns: list, chunksize: int = 1000000
+) -> pd.DataFrame:
+    """
+    Returns the hash and row count of each block of rows with the same
+    key in a csv file, indexed by key. A block's hash is the sum of the
+    hashes of its rows' values in columns, so it does not depend on the
+    order of the rows. Only the blocks are kept in memory.
+    """
+
+    parts = []
+    for chunk in read_chunks(path, chunksize):
+        hashes = pd.util.hash_pandas_object(chunk[columns], index=False)
+        keys = chunk[key] if key is not None else hashes.astype(str)
+        parts.append(
+            pd.DataFrame({"hash": hashes.to_numpy(), "rows": 1}, index=keys.to_numpy())
+            .groupby(level=0, sort=False)
+            .sum()
+        )
+    if len(parts) == 0:
+        return pd.DataFrame(
+            {"hash": pd.Series(dtype="uint64"), "rows": pd.Series(dtype="int64")}
+        )
+    # uint64 sums wrap around, so blocks split over chunks add up the same
+    return pd.concat(parts).groupby(level=0, sort=False).sum()
+
+
+def read_blocks(path: Path, key: str, keys: set, chunksize: int) -> pd.DataFrame:
+    """
+    Returns the rows of a csv file whose key is in keys.
+    """
+
+    chunks = [chunk[chunk[key].isin(keys)] for chunk in read_chunks(path, chunksize)]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def changed_columns(
+    old: pd.DataFrame, new: pd.DataFrame, key: str, sequence: str, columns: list
+) -> pd.Series:
+    """
+    Returns the names of the columns that differ in each changed block,
+    as a ';' separated string indexed by key. Rows are lined up by key
+    and sequence.
+    """
+
+    on = [key] if sequence is None or sequence not in columns else [key, sequence]
+    merged = old[columns].merge(
+        new[columns], on=on, how="outer", suffixes=("_old", "_new")
+    )
+    differs = pd.DataFrame(index=merged.index)
+    for column in columns:
+        if column not in on:
+            differs[column] = merged[f"{column}_old"].fillna("\0") != merged[
+                f"{column}_new"
+            ].fillna("\0")
+    differs = differs.groupby(merged[key]).any()
+    return differs.apply(lambda row: ";".join(row.index[row]), axis=1)
+
+
+def diff_table(
+    old_path: Path,
+    new_path: Path,
+    table: str,
+    chunksize: int = 1000000,
+    max_details: int = 100000,
+) -> tuple[dict, pd.DataFrame]:
+    """
+    Compares a table of two combined feeds. Returns a row of the diff
+    summary and the list of added, removed and changed blocks (see
+    table_keys). Unchanged blocks are found by their hashes alone; the
+    changed columns are listed for up to max_details changed blocks,
+    whose rows are read again.
+    """
+
+    old_columns = read_header(old_path)
+    new_columns = read_header(new_path)
+    columns = [column for column in old_columns if column in new_columns]
+    key = table_keys.get(table)
+    if key not in columns:
+        # rows can only be added or removed
+        key = None
+
+    old = hash_blocks(old_path, key, columns, chunksize)
+    new = hash_blocks(new_path, key, columns, chunksize)
+    common = old.index.intersection(new.index, sort=False)
+    changed = common[
+        old.loc[common, "hash"].to_numpy() != new.loc[common, "hash"].to_numpy()
+    ]
+    added = new.index.difference(old.index, sort=False)
+    removed = old.index.difference(new.index, sort=False)
+
+    changes = pd.concat(
+        [
+            pd.DataFrame(
+                {"change": "added", "rows_old": 0, "rows_new": new.loc[added, "rows"]}
+            ),
+            pd.DataFrame(
+                {
+                    "change": "removed",
+                    "rows_old": old.loc[removed, "rows"],
+                    "rows_new": 0,
+                }
+            ),
+            pd.DataFrame(
+                {
+                    "change": "changed",
+                    "rows_old": old.loc[changed, "rows"],
+                    "rows_new": new.loc[changed, "rows"],
+                }
+            ),
+        ]
+    )
+    changes["columns"] = ""
+    detail_keys = set(changed[:max_details])
+    if key is not None and len(detail_keys) > 0:
+        details = changed_columns(
+            read_blocks(old_path, key, detail_keys, chunksize),
+            read_blocks(new_path, key, detail_keys, chunksize),
+            key,
+            sequence_columns.get(table),
+            columns,
+        )
+        changes.loc[details.index, "columns"] = details
+
+    changes = changes.rename_axis("key").reset_index()
+    changes["table"] = table
+    summary = {
+        "table": table,
+        "rows_old": int(old["rows"].sum()),
+        "rows_new": int(new["rows"].sum()),
+        "added": len(added),
+        "removed": len(removed),
+        "changed": len(changed),
+        "unchanged": len(common) - len(changed),
+        "columns_added": ";".join(c for c in new_columns if c not in old_columns),
+        "columns_removed": ";".join(c for c in old_columns if c not in new_columns),
+    }
+    return summary, changes[change_columns]
+
+
+def diff_feeds(
+    old_dir,
+    new_dir,
+    tables: list = None,
+    chunksize: int = 1000000,
+    max_details: int = 100000,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compares two combined feeds, such as two outputs of Combined_GTFS,
+    table by table. Returns a summary with the number of added, removed,
+    changed and unchanged blocks of each table (see table_keys) and the
+    list of changed blocks. A table found in only one of the feeds counts
+    as one added or removed block and tables in neither are skipped.
+    Files are read in chunks of chunksize rows, so memory is bounded by
+    the number of blocks rather than rows. An output directory is read
+    from its current export (see export.feed_dir).
+    """
+
+    old_dir = feed_dir(old_dir)
+    new_dir = feed_dir(new_dir)
+    summaries = []
+    changes = []
+    for table in tables or list(table_keys):
+        old_path = old_dir / f"{table}.txt"
+        new_path = new_dir / f"{table}.txt"
+        if not old_path.exists() and not new_path.exists():
+            continue
+        if not old_path.exists() or not new_path.exists():
+            summaries.append(
+                {
+                    "table": table,
+                    "added": int(new_path.exists()),
+                    "removed": int(old_path.exists()),
+                }
+            )
+            continue
+        summary, table_changes = diff_table(
+            old_path, new_path, table, chunksize, max_details
+        )
+        summaries.append(summary)
+        changes.append(table_changes)
+
+    summary = pd.DataFrame(summaries, columns=summary_columns)
+    if len(changes) == 0:
+        return summary, pd.DataFrame(columns=change_columns)
+    return summary, pd.concat(changes, ignore_index=True)
+
+
+def diff(args: argparse.Namespace) -> None:
+    """
+    Implements the 'diff' sub-command, which compares two combined
+    feeds and writes diff_summary.csv and diff_changes.csv.
+    """
+
+    logger = log_controller.setup_custom_logger("main_logger", args.output_dir)
+    logger.info("------------------combine_gtfs_feeds diff Started----------------")
+
+    for path in [args.old_dir, args.new_dir]:
+        if not os.path.isdir(path):
+            logger.info("Directory path : {} does not exist.".format(path))
+            logger.info("Exiting application early!")
+            sys.exit()
+
+    summary, changes = diff_feeds(
+        args.old_dir, args.new_dir, args.tables, args.chunksize, args.max_details
+    )
+    for row in summary.itertuples():
+        logger.info(
+            f"{row.table}.txt: {row.added} added, {row.removed} removed,"
+            f" {row.changed} changed, {row.unchanged} unchanged"
+        )
+    output_dir = Path(args.output_dir)
+    summary.to_csv(output_dir / "diff_summary.csv", index=None)
+    changes.to_csv(output_dir / "diff_changes.csv", index=None)
+    logger.info("Finished running combine_gtfs_feeds diff")
+    sys.exit()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .gtfs_schema import GTFS_Schema
+except Exception:
+    from gtfs_schema import GTFS_Schema
+
+# repeated text (e.g. headsigns) is only made categorical in these tables
+categorical_tables = ["stops", "trips", "stop_times"]
+
+# text columns that are rewritten by combine, so they are left as is
+excluded_text_columns = ["arrival_time", "departure_time"]
+
+# share of unique values below which a text column is made categorical
+max_unique_ratio = 0.5
+
+# (dtype, nullable dtype) from smallest to largest
+integer_dtypes = [(np.int8, "Int8"), (np.int16, "Int16"), (np.int32, "Int32")]
+
+
+@lru_cache(maxsize=None)
+def schema_dtypes(file_name: str) -> dict:
+    """
+    Returns a dictionary of column name to pandera dtype name for the
+    columns of a GTFS file that GTFS_Schema coerces on validation.
+    Columns that are not coerced must keep their dtype to validate.
+    """
+
+    schema = GTFS_Schema.models[file_name].to_schema()
+    return {
+        name: str(column.dtype)
+        for name, column in schema.columns.items()
+        if column.coerce
+    }
+
+
+def downcast_integer(series: pd.Series) -> pd.Series:
+    """
+    Returns series as the smallest integer dtype that holds its values,
+    nullable (Int8, Int16, Int32) if it has missing values. Non-numeric
+    series and floats with fractions are returned unchanged.
+    """
+
+    if not pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        return series
+    values = series.dropna()
+    if len(values) == 0 or (values % 1 != 0).any():
+        return series
+    low, high = values.min(), values.max()
+    for dtype, nullable_dtype in integer_dtypes:
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            if len(values) < len(series):
+                return series.astype(nullable_dtype)
+            return series.astype(dtype)
+    return series
+
+
+def downcast_float(series: pd.Series) -> pd.Series:
+    """
+    Returns series as float32 if every value survives the round trip
+    to float32 and back unchanged, so the written output is the same.
+    """
+
+    if series.dtype != np.float64:
+        return series
+    values = series.to_numpy()
+    if np.array_equal(
+        values.astype(np.float32).astype(np.float64), values, equal_nan=True
+    ):
+        return series.astype(np.float32)
+    return series
+
+
+def to_categorical(series: pd.Series) -> pd.Series:
+    """
+    Returns a text series as categorical if few of its values are unique.
+    """
+
+    if series.dtype != object or len(series) == 0:
+        return series
+    if series.nunique() <= len(series) * max_unique_ratio:
+        return series.astype("category")
+    return series
+
+
+def optimize_dtypes(df: pd.DataFrame, file_name: str) -> pd.DataFrame:
+    """
+    Downcasts the columns of a GTFS table based on GTFS_Schema: integers
+    to the smallest integer dtype, floats to float32 where no precision
+    is lost and repeated text to categoricals. Values are unchanged, so
+    validation coerces them back and the exported files are the same.
+    """
+
+    if file_name not in GTFS_Schema.models:
+        return df
+    for name, dtype in schema_dtypes(file_name).items():
+        if name not in df.columns:
+            continue
+        if dtype in ["int64", "Int64"]:
+            df[name] = downcast_integer(df[name])
+        elif dtype == "float64":
+            df[name] = downcast_float(df[name])
+        elif (
+            dtype == "str"
+            and file_name in categorical_tables
+            and not name.endswith("_id")
+            and name not in excluded_text_columns
+        ):
+            df[name] = to_categorical(df[name])
+    return df
+
+
+def ids_as_text(values: pd.Series) -> pd.Series:
+    """
+    Returns ids as stripped text, to compare ids read as numbers in one
+    file and text in another. Floats that hold whole numbers, e.g. ids
+    read as float because some are blank, lose the '.0' so they match
+    the same ids read as integers. Missing values stay missing.
+    """
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.astype(values.cat.categories.dtype)
+    if pd.api.types.is_float_dtype(values):
+        present = values.dropna()
+        if (present % 1 == 0).all():
+            values = values.astype("Int64")
+    return values.astype(str).str.strip().where(values.notna())
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    """
+    Returns the memory used by a DataFrame in MB, including the
+    contents of text columns.
+    """
+
+    return df.memory_usage(deep=True).sum() / 1000**2
@@ -0,0 +1,988 @@
+"""
+Out-of-core engine for the 'run' sub-command. Performs the same steps as
+run.combine (service_id resolution, frequency expansion, trip filtering,
+ID prefixing and export) as SQL against an embedded DuckDB database that
+lives on disk, so combines larger than memory can spill to disk.
+"""
+
+from __future__ import annotations
+
+import csv
+import os as os
+import shutil
+import sys
+import tempfile
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import combine_gtfs_feeds.cli.log_controller as log_controller  # type: ignore
+
+from .export import (
+    hash_file,
+    line_offsets,
+    manifest_columns,
+    publish,
+    sorted_tables,
+    staging_dir,
+    write_csv,
+)
+from .gtfs_schema import GTFS_Schema
+from .run import Combined_GTFS, get_feed_list, get_start_end_date, get_weekday
+
+# pandera dtype name -> duckdb column type
+duckdb_types = {
+    "str": "VARCHAR",
+    "float64": "DOUBLE",
+    "int64": "BIGINT",
+    "Int64": "BIGINT",
+}
+
+# frequencies.txt is not part of GTFS_Schema
+frequencies_types = {
+    "trip_id": "VARCHAR",
+    "start_time": "VARCHAR",
+    "end_time": "VARCHAR",
+    "headway_secs": "BIGINT",
+}
+
+# sort keys used when writing out each combined file
+export_order = {
+    "agency": ["agency_id"],
+    "routes": ["route_id"],
+    "stops": ["stop_id"],
+    "trips": ["trip_id"],
+    "stop_times": ["trip_id", "stop_sequence"],
+    "shapes": ["shape_id", "shape_pt_sequence"],
+}
+
+feed_files = [
+    "calendar",
+    "calendar_dates",
+    "trips",
+    "stops",
+    "stop_times",
+    "frequencies",
+    "routes",
+    "shapes",
+    "agency",
+]
+
+macros = [
+    """
+    CREATE MACRO gtfs_secs(t) AS
+        CAST(split_part(t, ':', 1) AS BIGINT) * 3600
+        + CAST(split_part(t, ':', 2) AS BIGINT) * 60
+        + CAST(split_part(t, ':', 3) AS BIGINT)
+    """,
+    # matches run.to_hhmmss, which wraps times past midnight
+    """
+    CREATE MACRO gtfs_hhmmss(s) AS
+        printf('%02d:%02d:%02d', (s // 3600) % 24, (s // 60) % 60, s % 60)
+    """,
+]
+
+
+def quote(value: str) -> str:
+    """
+    Returns value as a SQL string literal.
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def quote_ident(value: str) -> str:
+    """
+    Returns value as a SQL identifier.
+    """
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def column_types(file_name: str) -> dict:
+    """
+    Returns a dictionary of column name to duckdb type for a GTFS file,
+    based on GTFS_Schema.
+    """
+    if file_name == "frequencies":
+        return frequencies_types
+    schema = GTFS_Schema.models[file_name].to_schema()
+    return {
+        name: duckdb_types.get(str(column.dtype), "VARCHAR")
+        for name, column in schema.columns.items()
+    }
+
+
+def read_header(csv_path: Path) -> list:
+    """
+    Returns the column names from the first line of a csv file.
+    """
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    return [col.strip().replace(" ", "") for col in header]
+
+
+def table_columns(con, table: str) -> list:
+    """
+    Returns the column names of a duckdb table or view.
+    """
+    return [row[0] for row in con.execute(f"DESCRIBE {table}").fetchall()]
+
+
+def table_count(con, table: str) -> int:
+    return con.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+
+def replace_table(con, table: str, select_sql: str) -> None:
+    """
+    Replaces table with the result of select_sql, which may read from table.
+    """
+    con.execute(f"CREATE TABLE {table}__new AS {select_sql}")
+    con.execute(f"DROP TABLE {table}")
+    con.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+
+
+def prefix_id(column: str, feed: str) -> str:
+    """
+    SQL version of run.create_id. Null ids stay null, so they are written
+    as empty fields like the pandas engine's output.
+    """
+    col = quote_ident(column)
+    return f"CASE WHEN {col} IS NULL THEN NULL ELSE {quote(feed + '_')} || {col} END"
+
+
+def locate_feed_files(
+    path: Path,
+    is_zipped: bool,
+    feed_name: str,
+    work_dir: Path,
+    logger: log_controller.logging.Logger,
+) -> dict:
+    """
+    Returns a dictionary of GTFS file name to csv path for a feed.
+    Zipped feeds are extracted to work_dir. Exits if a required
+    file is missing, like run.read_gtfs.
+    """
+
+    files = {}
+    if is_zipped:
+        with zipfile.ZipFile(path.with_suffix(".zip")) as zf:
+            members = set(zf.namelist())
+            for file_name in feed_files:
+                if f"{file_name}.txt" in members:
+                    zf.extract(f"{file_name}.txt", work_dir / feed_name)
+        path = work_dir / feed_name
+
+    for file_name in feed_files:
+        csv_path = path / f"{file_name}.txt"
+        if csv_path.exists():
+            files[file_name] = csv_path
+        elif f"{file_name}.txt" in GTFS_Schema.required_files:
+            logger.info(
+                f"Fatal! {file_name}.txt from feed {feed_name} is missing. Exiting"
+                " program"
+            )
+            sys.exit()
+    return files
+
+
+def load_csv(con, table: str, csv_path: Path, file_name: str) -> bool:
+    """
+    Loads a GTFS csv file into a duckdb table, using the GTFS_Schema
+    types for known columns and VARCHAR for all others. Text values
+    are stripped of surrounding whitespace. Returns False if the file
+    has no rows.
+    """
+
+    header = read_header(csv_path)
+    if not header:
+        return False
+    types = column_types(file_name)
+    columns = ", ".join(
+        f"{quote(col)}: {quote(types.get(col, 'VARCHAR'))}" for col in header
+    )
+    select_list = ", ".join(
+        (
+            f"trim({quote_ident(col)}) AS {quote_ident(col)}"
+            if types.get(col, "VARCHAR") == "VARCHAR"
+            else quote_ident(col)
+        )
+        for col in header
+    )
+    con.execute(
+        f"CREATE TABLE {table} AS SELECT {select_list} FROM read_csv("
+        f"{quote(str(csv_path))}, header = true, delim = ',', quote = '\"',"
+        f" escape = '\"', columns = {{{columns}}})"
+    )
+    return table_count(con, table) > 0
+
+
+def get_service_ids(
+    con, p: str, loaded: set, day_of_week: str, service_date: int
+) -> list:
+    """
+    SQL version of run.get_service_ids.
+    """
+
+    if "calendar" in loaded:
+        regular_service_dates = [
+            row[0]
+            for row in con.execute(
+                f"SELECT service_id FROM {p}calendar WHERE start_date <="
+                f" {service_date} AND end_date >= {service_date} AND"
+                f" {quote_ident(day_of_week)} = 1"
+            ).fetchall()
+        ]
+    else:
+        regular_service_dates = []
+
+    if "calendar_dates" in loaded:
+        exceptions = con.execute(
+            f"SELECT service_id, exception_type FROM {p}calendar_dates"
+            f" WHERE CAST(date AS BIGINT) = {service_date}"
+        ).fetchall()
+        add_service = [row[0] for row in exceptions if row[1] == 1]
+        remove_service = [row[0] for row in exceptions if row[1] == 2]
+    else:
+        add_service = []
+        remove_service = []
+
+    return [x for x in (add_service + regular_service_dates) if x not in remove_service]
+
+
+def select_routes(con, p: str, feed: str, route_filter: dict) -> int:
+    """
+    SQL version of run.select_routes. Keeps the routes selected by
+    route_filter, with their trips and agencies, and returns the
+    number of routes kept.
+    """
+
+    routes_columns = table_columns(con, f"{p}routes")
+    agency_columns = table_columns(con, f"{p}agency")
+    conditions = []
+    if route_filter["agencies"]:
+        agencies = ", ".join(quote(i) for i in route_filter["agencies"])
+        agency_condition = " OR ".join(
+            f"CAST({col} AS VARCHAR) IN ({agencies})"
+            for col in ["agency_id", "agency_name"]
+            if col in agency_columns
+        )
+        if "agency_id" in routes_columns and "agency_id" in agency_columns:
+            conditions.append(
+                f"agency_id IN (SELECT agency_id FROM {p}agency"
+                f" WHERE {agency_condition})"
+            )
+        else:
+            # routes without agency_id belong to the feed's only agency
+            conditions.append(
+                f"EXISTS (SELECT 1 FROM {p}agency WHERE {agency_condition})"
+            )
+    if route_filter["route_types"]:
+        route_types = ", ".join(str(int(i)) for i in route_filter["route_types"])
+        conditions.append(f"route_type IN ({route_types})")
+    if route_filter["routes"]:
+        route_ids = ", ".join(quote(i) for i in route_filter["routes"])
+        conditions.append(
+            f"(route_id IN ({route_ids}) OR {quote(feed + '_')} || route_id"
+            f" IN ({route_ids}))"
+        )
+
+    replace_table(
+        con,
+        f"{p}routes",
+        f"SELECT * FROM {p}routes WHERE {' AND '.join(conditions)}",
+    )
+    replace_table(
+        con,
+        f"{p}trips",
+        f"SELECT * FROM {p}trips WHERE route_id IN (SELECT route_id FROM {p}routes)",
+    )
+    if "agency_id" in routes_columns and "agency_id" in agency_columns:
+        replace_table(
+            con,
+            f"{p}agency",
+            f"SELECT * FROM {p}agency"
+            f" WHERE agency_id IN (SELECT agency_id FROM {p}routes)",
+        )
+    return table_count(con, f"{p}routes")
+
+
+def frequencies_to_trips(con, p: str, time_window=None) -> None:
+    """
+    SQL version of run.frequencies_to_trips. Replaces each trip_id in
+    frequencies.txt with one trip per headway in trips and stop_times.
+    If time_window is given, headways are limited to the trips inside
+    the window before they are expanded, like run.trim_frequencies.
+    """
+
+    first_k = "0"
+    last_k = "total_trips - 1"
+    duration = "0"
+    spans = ""
+    if time_window is not None:
+        start_secs, end_secs, time_rule = time_window
+        if time_rule != "starts":
+            duration = "coalesce(s.last_secs - s.first_secs, 0)"
+            spans = f"""
+                LEFT JOIN (
+                    SELECT
+                        trip_id,
+                        min(coalesce(gtfs_secs(departure_time), gtfs_secs(arrival_time)))
+                            AS first_secs,
+                        max(coalesce(gtfs_secs(arrival_time), gtfs_secs(departure_time)))
+                            AS last_secs
+                    FROM {p}stop_times
+                    GROUP BY trip_id
+                ) s ON f.trip_id = s.trip_id
+                """
+        first_k = (
+            f"greatest(CAST(ceil(({start_secs} - duration - start_secs)"
+            " / headway_secs) AS BIGINT), 0)"
+        )
+        if end_secs != float("inf"):
+            last_k = (
+                f"least({last_k}, CAST(ceil(({end_secs} - start_secs)"
+                " / headway_secs) AS BIGINT) - 1)"
+            )
+
+    # counter_offset numbers the trips of a trip_id across its rows, so
+    # trips keep the trip_ids they would have without the window
+    con.execute(f"""
+        CREATE TABLE {p}freq_trips AS
+        SELECT
+            trip_id,
+            start_secs + k * headway_secs AS trip_start_secs,
+            counter_offset + k + 1 AS counter
+        FROM (
+            SELECT
+                trip_id,
+                start_secs,
+                headway_secs,
+                counter_offset,
+                unnest(range({first_k}, {last_k} + 1)) AS k
+            FROM (
+                SELECT
+                    f.trip_id,
+                    start_secs,
+                    headway_secs,
+                    total_trips,
+                    {duration} AS duration,
+                    coalesce(sum(total_trips) OVER (
+                        PARTITION BY f.trip_id ORDER BY start_secs
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                    ), 0) AS counter_offset
+                FROM (
+                    SELECT
+                        trip_id,
+                        gtfs_secs(start_time) AS start_secs,
+                        headway_secs,
+                        CAST(round_even(
+                            (gtfs_secs(end_time) - gtfs_secs(start_time))
+                            / headway_secs, 0
+                        ) AS BIGINT) AS total_trips
+                    FROM {p}frequencies
+                ) f
+                {spans}
+            )
+        )
+        """)
+    replace_table(
+        con,
+        f"{p}trips",
+        f"""
+        SELECT * FROM {p}trips
+        WHERE trip_id NOT IN (SELECT trip_id FROM {p}frequencies)
+        UNION ALL BY NAME
+        SELECT t.* REPLACE (t.trip_id || '_' || ft.counter AS trip_id)
+        FROM {p}trips t
+        JOIN {p}freq_trips ft ON t.trip_id = ft.trip_id
+        """,
+    )
+    # for now assume departure time is the same as arrival time.
+    new_time = (
+        "gtfs_hhmmss(ft.trip_start_secs + gtfs_secs(st.arrival_time) - fa.first_secs)"
+    )
+    replace_table(
+        con,
+        f"{p}stop_times",
+        f"""
+        SELECT * FROM {p}stop_times
+        WHERE trip_id NOT IN (SELECT trip_id FROM {p}frequencies)
+        UNION ALL BY NAME
+        SELECT st.* REPLACE (
+            st.trip_id || '_' || ft.counter AS trip_id,
+            {new_time} AS arrival_time,
+            {new_time} AS departure_time
+        )
+        FROM {p}stop_times st
+        JOIN {p}freq_trips ft ON st.trip_id = ft.trip_id
+        JOIN (
+            SELECT trip_id, arg_min(gtfs_secs(arrival_time), stop_sequence) AS first_secs
+            FROM {p}stop_times
+            GROUP BY trip_id
+        ) fa ON st.trip_id = fa.trip_id
+        """,
+    )
+    con.execute(f"DROP TABLE {p}freq_trips")
+
+
+def shapes_from_stops_sequence(con, p: str) -> None:
+    """
+    SQL version of run.shapes_from_stops_sequence. Creates shapes from the
+    stop locations of one representative trip per route and unique stop
+    sequence, and assigns that trip_id as the shape_id of its trips.
+    """
+
+    con.execute(f"""
+        CREATE TABLE {p}patterns AS
+        SELECT
+            trip_id,
+            min(trip_id) OVER (PARTITION BY route_id, stop_pattern) AS shape_id
+        FROM (
+            SELECT
+                st.trip_id,
+                t.route_id,
+                string_agg(st.stop_id, chr(31) ORDER BY st.stop_sequence) AS stop_pattern
+            FROM {p}stop_times st
+            JOIN {p}trips t ON st.trip_id = t.trip_id
+            GROUP BY st.trip_id, t.route_id
+        )
+        """)
+    con.execute(f"DROP TABLE IF EXISTS {p}shapes")
+    con.execute(f"""
+        CREATE TABLE {p}shapes AS
+        SELECT
+            pt.shape_id,
+            s.stop_lat AS shape_pt_lat,
+            s.stop_lon AS shape_pt_lon,
+            st.stop_sequence AS shape_pt_sequence
+        FROM {p}patterns pt
+        JOIN {p}stop_times st ON st.trip_id = pt.trip_id
+        LEFT JOIN {p}stops s ON st.stop_id = s.stop_id
+        WHERE pt.trip_id = pt.shape_id
+        """)
+    exclude = (
+        " EXCLUDE (shape_id)" if "shape_id" in table_columns(con, f"{p}trips") else ""
+    )
+    replace_table(
+        con,
+        f"{p}trips",
+        f"""
+        SELECT t.*{exclude}, pt.shape_id
+        FROM {p}trips t
+        JOIN {p}patterns pt ON t.trip_id = pt.trip_id
+        """,
+    )
+    con.execute(f"DROP TABLE {p}patterns")
+
+
+def filter_time_window(con, p: str, time_window: tuple) -> None:
+    """
+    SQL version of run.filter_time_window. Removes trips outside of
+    time_window, a (start_secs, end_secs, time_rule) tuple. Their
+    stop_times are removed with the trip filter.
+    """
+
+    start_secs, end_secs, time_rule = time_window
+    if time_rule == "starts":
+        conditions = [f"first_secs >= {start_secs}"]
+    else:
+        conditions = [f"last_secs >= {start_secs}"]
+    if end_secs != float("inf"):
+        conditions.append(f"first_secs < {end_secs}")
+    replace_table(
+        con,
+        f"{p}trips",
+        f"""
+        SELECT * FROM {p}trips
+        WHERE trip_id NOT IN (
+            SELECT trip_id
+            FROM (
+                SELECT
+                    trip_id,
+                    min(coalesce(gtfs_secs(departure_time), gtfs_secs(arrival_time)))
+                        AS first_secs,
+                    max(coalesce(gtfs_secs(arrival_time), gtfs_secs(departure_time)))
+                        AS last_secs
+                FROM {p}stop_times
+                GROUP BY trip_id
+            )
+            WHERE NOT ({" AND ".join(conditions)})
+        )
+        """,
+    )
+
+
+def interpolate_arrival_departure_time(con, p: str) -> None:
+    """
+    SQL version of run.interpolate_arrival_departure_time. Missing (or
+    00:00:00) times are linearly interpolated between the surrounding
+    known times after sorting by trip_id and stop_sequence.
+    """
+
+    cols = ["arrival_time", "departure_time"]
+    secs = ", ".join(
+        f"NULLIF(gtfs_secs(coalesce({col}, '00:00:00')), 0) AS _{col}_secs"
+        for col in cols
+    )
+    windows = ", ".join(f"""
+        last_value(CASE WHEN _{col}_secs IS NOT NULL THEN _pos END IGNORE NULLS)
+            OVER prev AS _{col}_p0,
+        last_value(_{col}_secs IGNORE NULLS) OVER prev AS _{col}_v0,
+        first_value(CASE WHEN _{col}_secs IS NOT NULL THEN _pos END IGNORE NULLS)
+            OVER next AS _{col}_p1,
+        first_value(_{col}_secs IGNORE NULLS) OVER next AS _{col}_v1
+        """ for col in cols)
+    interpolated = ", ".join(f"""
+        gtfs_hhmmss(CAST(floor(
+            CASE WHEN _{col}_p1 IS NULL OR _{col}_p1 = _{col}_p0 THEN _{col}_v0
+            ELSE _{col}_v0 + (_{col}_v1 - _{col}_v0) * (_pos - _{col}_p0)
+                / (_{col}_p1 - _{col}_p0)
+            END
+        ) AS BIGINT)) AS {col}
+        """ for col in cols)
+    helpers = ", ".join(
+        ["_pos"]
+        + [
+            f"_{col}_{suffix}"
+            for col in cols
+            for suffix in ["secs", "p0", "v0", "p1", "v1"]
+        ]
+    )
+    replace_table(
+        con,
+        f"{p}stop_times",
+        f"""
+        WITH ordered AS (
+            SELECT *, row_number() OVER (ORDER BY trip_id, stop_sequence) AS _pos, {secs}
+            FROM {p}stop_times
+        ),
+        bounds AS (
+            SELECT *, {windows}
+            FROM ordered
+            WINDOW
+                prev AS (ORDER BY _pos ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW),
+                next AS (ORDER BY _pos ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING)
+        )
+        SELECT * EXCLUDE ({helpers}) REPLACE ({interpolated})
+        FROM bounds
+        ORDER BY _pos
+        """,
+    )
+
+
+def process_feed(
+    con,
+    p: str,
+    feed: str,
+    files: dict,
+    service_date: int,
+    day_of_week: str,
+    logger: log_controller.logging.Logger,
+    time_window=None,
+    route_filter=None,
+) -> bool:
+    """
+    Loads a single feed into duckdb tables named with prefix p and applies
+    the same filtering and ID changes as run.combine. Returns False if
+    route_filter selects no routes from the feed.
+    """
+
+    loaded = set()
+    for file_name, csv_path in files.items():
+        if load_csv(con, f"{p}{file_name}", csv_path, file_name):
+            loaded.add(file_name)
+        else:
+            con.execute(f"DROP TABLE IF EXISTS {p}{file_name}")
+            if file_name != "shapes":
+                logger.info(f"Warning! {file_name}.txt from feed {feed} is empty.")
+
+    if route_filter is not None:
+        if select_routes(con, p, feed, route_filter) == 0:
+            logger.info(f"No routes selected from feed {feed}, skipping feed")
+            return False
+
+    service_id_list = get_service_ids(con, p, loaded, day_of_week, service_date)
+    if len(service_id_list) == 0:
+        logger.info(
+            "There are no service ids for service                 date {}...".format(
+                service_date
+            )
+        )
+        logger.info("for feed {}".format(feed))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    for id in service_id_list:
+        logger.info("Adding service_id {} for feed {}".format(id, feed))
+
+    if "frequencies" in loaded:
+        logger.info(f"Feed {feed} contains frequencies.txt...")
+        logger.info(
+            "Unique trips will be added to outputs based on headways in"
+            " frequencies.txt"
+        )
+        frequencies_to_trips(con, p, time_window)
+
+    if time_window is not None:
+        filter_time_window(con, p, time_window)
+
+    if "agency_id" not in table_columns(con, f"{p}routes"):
+        replace_table(
+            con,
+            f"{p}routes",
+            f"SELECT *, (SELECT agency_id FROM {p}agency LIMIT 1) AS agency_id"
+            f" FROM {p}routes",
+        )
+
+    # check to make sure there are shapes
+    if "shapes" not in loaded:
+        logger.info(
+            f"Warning: feed {feed} is mising shapes.txt. Records for this file will"
+            " be created using route-level unique stop sequence and location. See"
+            " documentation for more information."
+        )
+        shapes_from_stops_sequence(con, p)
+
+    # trips
+    service_ids = ", ".join(quote(id) for id in service_id_list)
+    replace_table(
+        con,
+        f"{p}trips",
+        f"SELECT * FROM {p}trips WHERE service_id IN ({service_ids})",
+    )
+    if table_count(con, f"{p}trips") == 0:
+        logger.info(
+            f"Warning! No trips found for feed {feed} using service_ids"
+            f" {str(service_id_list)}"
+        )
+
+    # stop times
+    replace_table(
+        con,
+        f"{p}stop_times",
+        f"SELECT * FROM {p}stop_times"
+        f" WHERE trip_id IN (SELECT trip_id FROM {p}trips)",
+    )
+    missing_times = con.execute(
+        f"SELECT count(*) FROM {p}stop_times WHERE departure_time IS NULL"
+    ).fetchone()[0]
+    if missing_times > 0:
+        logger.info(
+            "Feed {} contains missing departure/arrival times. Interpolating"
+            " missing times.".format(feed)
+        )
+        interpolate_arrival_departure_time(con, p)
+
+    # stops, routes, shapes
+    replace_table(
+        con,
+        f"{p}stops",
+        f"SELECT * FROM {p}stops"
+        f" WHERE stop_id IN (SELECT stop_id FROM {p}stop_times)",
+    )
+    replace_table(
+        con,
+        f"{p}routes",
+        f"SELECT * FROM {p}routes WHERE route_id IN (SELECT route_id FROM {p}trips)",
+    )
+    replace_table(
+        con,
+        f"{p}shapes",
+        f"SELECT * FROM {p}shapes WHERE shape_id IN (SELECT shape_id FROM {p}trips)",
+    )
+
+    # create new IDs
+    id_columns = {
+        "trips": ["trip_id", "route_id", "shape_id"],
+        "shapes": ["shape_id"],
+        "stop_times": ["trip_id", "stop_id"],
+        "stops": ["stop_id"],
+        "routes": ["route_id"],
+    }
+    for file_name, columns in id_columns.items():
+        existing = table_columns(con, f"{p}{file_name}")
+        replacements = [
+            f"{prefix_id(col, feed)} AS {quote_ident(col)}"
+            for col in columns
+            if col in existing
+        ]
+        if file_name == "trips":
+            replacements.append("1 AS service_id")
+        replace_table(
+            con,
+            f"{p}{file_name}",
+            f"SELECT * REPLACE ({', '.join(replacements)}) FROM {p}{file_name}",
+        )
+
+    if "route_short_name" in table_columns(con, f"{p}routes"):
+        replace_table(
+            con,
+            f"{p}routes",
+            f"SELECT * REPLACE (coalesce(route_short_name, route_id) AS"
+            f" route_short_name) FROM {p}routes",
+        )
+
+    for file_name in ["calendar", "calendar_dates", "frequencies"]:
+        con.execute(f"DROP TABLE IF EXISTS {p}{file_name}")
+    return True
+
+
+def validate_table(con, table: str, file_name: str) -> None:
+    """
+    Checks a combined table against GTFS_Schema: required columns,
+    non-nullable columns and isin/ge checks. Raises a ValueError
+    listing every failure.
+    """
+
+    schema = GTFS_Schema.models[file_name].to_schema()
+    existing = table_columns(con, table)
+    failures = []
+    for name, column in schema.columns.items():
+        if name not in existing:
+            if column.required:
+                failures.append(f"column '{name}' is missing")
+            continue
+        conditions = []
+        if not column.nullable:
+            conditions.append((f"{quote_ident(name)} IS NULL", "null values"))
+        for check in column.checks:
+            if check.name == "isin":
+                allowed = ", ".join(str(v) for v in check.statistics["allowed_values"])
+                conditions.append(
+                    (
+                        f"{quote_ident(name)} NOT IN ({allowed})",
+                        f"values not in [{allowed}]",
+                    )
+                )
+            elif check.name == "greater_than_or_equal_to":
+                min_value = check.statistics["min_value"]
+                conditions.append(
+                    (f"{quote_ident(name)} < {min_value}", f"values < {min_value}")
+                )
+        for condition, description in conditions:
+            count = con.execute(
+                f"SELECT count(*) FROM {table} WHERE {condition}"
+            ).fetchone()[0]
+            if count > 0:
+                failures.append(f"column '{name}' has {count} {description}")
+    if failures:
+        raise ValueError(f"{file_name}.txt failed validation: " + "; ".join(failures))
+
+
+def export_table(con, table: str, file_name: str, output_dir: Path) -> int:
+    """
+    Writes a combined table to output_dir, keeping the GTFS_Schema
+    columns in schema order like Combined_GTFS.export_feed, and returns
+    the number of rows written.
+    """
+
+    existing = table_columns(con, table)
+    columns = [col for col in column_types(file_name) if col in existing]
+    order = [col for col in export_order.get(file_name, []) if col in existing]
+    order_by = (
+        f" ORDER BY {', '.join(quote_ident(col) for col in order)}" if order else ""
+    )
+    return con.execute(
+        f"COPY (SELECT {', '.join(quote_ident(col) for col in columns)} FROM {table}"
+        f"{order_by}) TO {quote(str(output_dir / f'{file_name}.txt'))}"
+        " (HEADER, DELIMITER ',')"
+    ).fetchone()[0]
+
+
+def index_table(con, table: str, key: str, path: Path) -> pd.DataFrame:
+    """
+    Returns the index of a table written by export_table, sorted by key,
+    to path, with the same columns as export.write_indexed_csv. Rows are
+    counted in duckdb and the byte offsets found by scanning the file.
+    If a value has a line break, the byte offsets are left empty.
+    """
+
+    index = con.execute(
+        f"SELECT {quote_ident(key)}, count(*) AS rows FROM {table}"
+        f" GROUP BY {quote_ident(key)} ORDER BY {quote_ident(key)}"
+    ).df()
+    rows = index["rows"].to_numpy(dtype=np.int64)
+    first_rows = np.cumsum(rows) - rows
+    # row i is line i + 1 of the file, after the header
+    offsets, breaks = line_offsets(
+        path, np.append(first_rows, first_rows[-1:] + rows[-1:]) + 1
+    )
+    index.insert(1, "first_row", first_rows)
+    index["byte_offset"] = pd.array(offsets[:-1], dtype="Int64")
+    index["bytes"] = pd.array(np.diff(offsets), dtype="Int64")
+    if breaks != rows.sum() + 1:
+        index["byte_offset"] = pd.NA
+        index["bytes"] = pd.NA
+    return index
+
+
+def combine_duckdb(
+    gtfs_dir: str,
+    service_date,
+    output_dir,
+    logger=None,
+    work_dir=None,
+    memory_limit=None,
+    time_window=None,
+    route_filter=None,
+    sorted_output=False,
+) -> None:
+    """
+    Combines GTFS feeds using an embedded DuckDB database and writes the
+    combined feed to output_dir. The database and any spill files are
+    kept in a temporary directory under work_dir (default: the system
+    temp dir), and memory_limit (e.g. '8GB') caps duckdb's memory use.
+    time_window is a (start_secs, end_secs, time_rule) tuple from
+    run.get_time_window and route_filter comes from run.get_route_filter.
+    Tables are always written sorted; with sorted_output, the tables in
+    export.sorted_tables also get a sidecar index like export_feed.
+    """
+
+    try:
+        import duckdb
+    except ImportError:
+        duckdb = None
+
+    if not logger:
+        logger = log_controller.setup_custom_logger("main_logger", output_dir)
+        logger.info("------------------combine_gtfs_feeds Started----------------")
+
+    if duckdb is None:
+        logger.info(
+            "The duckdb engine requires the duckdb package. Install it with"
+            " 'pip install combine-gtfs-feeds[duckdb]'."
+        )
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    if not os.path.isdir(output_dir):
+        print("Output Directory path : {} does not exist.".format(output_dir))
+        print("Exiting application early!")
+        sys.exit()
+
+    dir = Path(gtfs_dir)
+    str_service_date = str(service_date)
+    my_date = datetime(
+        int(str_service_date[0:4]),
+        int(str_service_date[4:6]),
+        int(str_service_date[6:8]),
+    )
+
+    logger.info("GTFS Directory path is: {}".format(dir))
+    logger.info("Output Directory path is: {}".format(output_dir))
+    logger.info("Service Date is: {}".format(str_service_date))
+
+    if not os.path.isdir(dir):
+        logger.info("GTFS Directory path : {} does not exist.".format(dir))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    start_date, end_date = get_start_end_date(my_date)
+    day_of_week = get_weekday(my_date)
+    feed_list, zipped = get_feed_list(dir)
+
+    if len(feed_list) == 0:
+        logger.info("There are no GTFS feeds in GTFS Directory path : {}.".format(dir))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    temp_dir = Path(tempfile.mkdtemp(prefix="combine_gtfs_", dir=work_dir))
+    stage_dir = None
+    try:
+        con = duckdb.connect(str(temp_dir / "combine.duckdb"))
+        con.execute(f"SET temp_directory = {quote(str(temp_dir / 'spill'))}")
+        # rows are sorted on export so insertion order does not matter
+        con.execute("SET preserve_insertion_order = false")
+        if memory_limit:
+            con.execute(f"SET memory_limit = {quote(memory_limit)}")
+        for macro in macros:
+            con.execute(macro)
+
+        prefixes = []
+        for i, feed in enumerate(feed_list):
+            files = locate_feed_files(
+                dir / feed, zipped, feed, temp_dir / "extracted", logger
+            )
+            if process_feed(
+                con,
+                f"f{i}_",
+                feed,
+                files,
+                service_date,
+                day_of_week,
+                logger,
+                time_window,
+                route_filter,
+            ):
+                prefixes.append(f"f{i}_")
+            shutil.rmtree(temp_dir / "extracted" / feed, ignore_errors=True)
+
+        if len(prefixes) == 0:
+            logger.info("No routes selected from any feed.")
+            logger.info("Exiting application early!")
+            sys.exit()
+
+        # files are written to a staging directory and published once
+        # they are all written, like Combined_GTFS.export_feed
+        stage_dir = staging_dir(output_dir)
+        rows = {}
+        for file_name in Combined_GTFS.file_list:
+            con.execute(
+                f"CREATE VIEW combined_{file_name} AS "
+                + " UNION ALL BY NAME ".join(
+                    f"SELECT * FROM {p}{file_name}" for p in prefixes
+                )
+            )
+            validate_table(con, f"combined_{file_name}", file_name)
+            rows[f"{file_name}.txt"] = export_table(
+                con, f"combined_{file_name}", file_name, stage_dir
+            )
+            if sorted_output and f"{file_name}.txt" in sorted_tables:
+                index = index_table(
+                    con,
+                    f"combined_{file_name}",
+                    sorted_tables[f"{file_name}.txt"][0],
+                    stage_dir / f"{file_name}.txt",
+                )
+                write_csv(index, stage_dir / f"{file_name}_index.csv")
+                rows[f"{file_name}_index.csv"] = len(index)
+
+        # calendar
+        day_values = ", ".join(
+            f"{int(day == day_of_week)} AS {day}"
+            for day in [
+                "monday",
+                "tuesday",
+                "wednesday",
+                "thursday",
+                "friday",
+                "saturday",
+                "sunday",
+            ]
+        )
+        rows["calendar.txt"] = con.execute(
+            f"COPY (SELECT 1 AS service_id, {day_values}, {start_date} AS start_date,"
+            f" {end_date} AS end_date) TO {quote(str(stage_dir / 'calendar.txt'))}"
+            " (HEADER, DELIMITER ',')"
+        ).fetchone()[0]
+        con.close()
+
+        manifest = pd.DataFrame(
+            [
+                {
+                    "file": file_name,
+                    "rows": count,
+                    "bytes": (stage_dir / file_name).stat().st_size,
+                    "hash": hash_file(stage_dir / file_name),
+                }
+                for file_name, count in rows.items()
+            ],
+            columns=manifest_columns,
+        )
+        publish(stage_dir, output_dir, manifest, logger)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if stage_dir is not None:
+            shutil.rmtree(stage_dir, ignore_errors=True)
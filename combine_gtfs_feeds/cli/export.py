@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import hashlib
+import os as os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+manifest_file = "manifest.csv"
+
+# each export is written to its own directory in versions_dir and the
+# current_link symlink in output_dir is switched to it once it is complete
+versions_dir = ".exports"
+
+current_link = "current"
+
+manifest_columns = ["file", "rows", "bytes", "hash"]
+
+# sort keys of the tables written in sorted order. Each one also gets a
+# sidecar index keyed by its first sort key.
+sorted_tables = {
+    "stop_times.txt": ["trip_id", "stop_sequence"],
+    "shapes.txt": ["shape_id", "shape_pt_sequence"],
+}
+
+index_columns = ["first_row", "rows", "byte_offset", "bytes"]
+
+
+class Hashing_Writer:
+    """
+    Text file wrapper that hashes everything written to it, so a table
+    is hashed while it is serialized rather than read back.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.blake2b(digest_size=16)
+
+    def write(self, text: str) -> int:
+        self.digest.update(text.encode("utf-8"))
+        return self.f.write(text)
+
+    def hexdigest(self) -> str:
+        return self.digest.hexdigest()
+
+
+def write_csv(df: pd.DataFrame, path: Path) -> str:
+    """
+    Writes df to a csv file the same way as df.to_csv(path, index=None)
+    and returns the hash of the file's contents.
+    """
+
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = Hashing_Writer(f)
+        df.to_csv(writer, index=None)
+    return writer.hexdigest()
+
+
+def sort_rows(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+    """
+    Returns df sorted by columns. Each column is factorized to sorted
+    integer codes and the codes are sorted together with np.lexsort,
+    which is faster than sorting on the text ids themselves.
+    """
+
+    codes = [
+        pd.factorize(df[col], sort=True)[0]
+        for col in reversed(columns)
+        if col in df.columns
+    ]
+    if len(codes) == 0:
+        return df
+    return df.iloc[np.lexsort(codes)]
+
+
+def write_indexed_csv(
+    df: pd.DataFrame, path: Path, key: str, chunksize: int = 100000
+) -> tuple[str, pd.DataFrame]:
+    """
+    Writes df, sorted so that the rows of each key are contiguous, to a
+    csv file like write_csv and returns the hash of the file and an index
+    with the first row, number of rows, byte offset and number of bytes
+    of each key's rows. Rows are numbered from 0 after the header. If a
+    value has a line break, the byte offsets are left empty.
+    """
+
+    row_starts = np.zeros(len(df) + 1, dtype=np.int64)
+    offsets_valid = True
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "wb") as f:
+        header = df.head(0).to_csv(index=None).encode("utf-8")
+        f.write(header)
+        digest.update(header)
+        offset = len(header)
+        for start in range(0, len(df), chunksize):
+            chunk = df.iloc[start : start + chunksize]
+            text = chunk.to_csv(index=None, header=False).encode("utf-8")
+            line_ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == 10) + 1
+            if len(line_ends) == len(chunk):
+                row_starts[start + 1 : start + len(chunk) + 1] = offset + line_ends
+            else:
+                offsets_valid = False
+            f.write(text)
+            digest.update(text)
+            offset += len(text)
+    row_starts[0] = len(header)
+
+    codes = pd.factorize(df[key])[0]
+    first_rows = np.flatnonzero(np.diff(codes, prepend=-2))
+    rows = np.diff(first_rows, append=len(df))
+    index = pd.DataFrame(
+        {
+            key: df[key].to_numpy()[first_rows],
+            "first_row": first_rows,
+            "rows": rows,
+            "byte_offset": pd.array(row_starts[first_rows], dtype="Int64"),
+            "bytes": pd.array(
+                row_starts[first_rows + rows] - row_starts[first_rows], dtype="Int64"
+            ),
+        }
+    )
+    if not offsets_valid:
+        index["byte_offset"] = pd.NA
+        index["bytes"] = pd.NA
+    return digest.hexdigest(), index
+
+
+def line_offsets(
+    path: Path, lines: np.ndarray, block_size=16 * 1024**2
+) -> tuple[np.ndarray, int]:
+    """
+    Returns the byte offset of the start of each line number in lines,
+    sorted and counted from 0, and the number of line breaks in the
+    file. The file is scanned in blocks, so only the offsets asked for
+    are kept in memory. Line numbers past the end are returned as -1.
+    """
+
+    offsets = np.full(len(lines), -1, dtype=np.int64)
+    offsets[lines == 0] = 0
+    breaks = 0
+    position = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            # line breaks + 1 + i starts after the i-th line break in block
+            starts = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            starts += position + 1
+            first = np.searchsorted(lines, breaks + 1)
+            last = np.searchsorted(lines, breaks + len(starts), side="right")
+            offsets[first:last] = starts[lines[first:last] - breaks - 1]
+            breaks += len(starts)
+            position += len(block)
+    return offsets, breaks
+
+
+def read_manifest(dir: Path) -> dict:
+    """
+    Returns a dictionary of file name to (hash, bytes) from the manifest
+    in dir, or an empty dictionary if there is none.
+    """
+
+    try:
+        manifest = pd.read_csv(dir / manifest_file, dtype={"hash": str})
+    except (OSError, pd.errors.ParserError, pd.errors.EmptyDataError):
+        return {}
+    return {
+        row.file: (row.hash, int(row.bytes))
+        for row in manifest.itertuples()
+        if isinstance(row.hash, str)
+    }
+
+
+def hash_file(path: Path, block_size=1024**2) -> str:
+    """
+    Returns the hash of a file's contents, the same hash as write_csv.
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def staging_dir(output_dir) -> Path:
+    """
+    Returns a new staging directory in output_dir. It is on the same
+    file system as output_dir, so it can be published with a rename.
+    """
+
+    return Path(tempfile.mkdtemp(prefix=".export_", dir=output_dir))
+
+
+def feed_dir(dir) -> Path:
+    """
+    Returns the directory with the combined feed in dir: the published
+    export if dir is an output directory, otherwise dir itself.
+    """
+
+    dir = Path(dir)
+    if (dir / current_link).is_dir():
+        return dir / current_link
+    return dir
+
+
+def link_file(source: Path, target: Path) -> None:
+    """
+    Replaces target with a hard link to source, or a copy if the file
+    system does not support hard links.
+    """
+
+    temp = target.with_name(target.name + ".link")
+    try:
+        os.link(source, temp)
+    except OSError:
+        shutil.copy2(source, temp)
+    os.replace(temp, target)
+
+
+def remove_legacy_files(dir: Path) -> None:
+    """
+    Removes the files of an export written straight to dir, before
+    exports were published to their own directory.
+    """
+
+    if not (dir / manifest_file).is_file():
+        return
+    for file_name in read_manifest(dir):
+        if Path(file_name).name == file_name:
+            (dir / file_name).unlink(missing_ok=True)
+    (dir / manifest_file).unlink()
+
+
+def publish(stage_dir: Path, output_dir, manifest: pd.DataFrame, logger=None) -> None:
+    """
+    Publishes stage_dir, holding the files listed in manifest, as the
+    combined feed in output_dir. The manifest is written to stage_dir,
+    which is moved to output_dir/.exports and made the target of the
+    output_dir/current link with a single atomic rename, so readers see
+    either the previous or the new export, never a mix of the two.
+    Files whose hash and size match the previous export are replaced
+    with hard links to it. The previous export is kept for readers
+    that are still reading it; older exports are removed.
+    """
+
+    dir = Path(output_dir)
+    current = dir / current_link
+    previous = read_manifest(current)
+    unchanged = []
+    for row in manifest.itertuples():
+        old = current / row.file
+        if (
+            previous.get(row.file) == (row.hash, row.bytes)
+            and old.is_file()
+            and old.stat().st_size == row.bytes
+        ):
+            link_file(old, stage_dir / row.file)
+            unchanged.append(row.file)
+    manifest.to_csv(stage_dir / manifest_file, index=None)
+
+    versions = dir / versions_dir
+    versions.mkdir(exist_ok=True)
+    version = versions / stage_dir.name.lstrip(".")
+    # mkdtemp makes the staging directory private to its owner
+    os.chmod(stage_dir, 0o755)
+    os.rename(stage_dir, version)
+    keep = {version.resolve()}
+    if current.is_symlink():
+        keep.add(current.resolve())
+    link = dir / f".{current_link}.link"
+    link.unlink(missing_ok=True)
+    os.symlink(os.path.relpath(version, dir), link)
+    os.replace(link, current)
+
+    for path in versions.iterdir():
+        if path.resolve() not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+    remove_legacy_files(dir)
+    if logger:
+        logger.info(
+            "Exported {} files to {}, {} unchanged files were linked from the"
+            " previous export".format(len(manifest), current, len(unchanged))
+        )
+
+
+def export_tables(
+    tables: dict, output_dir, logger=None, sorted_output=False
+) -> pd.DataFrame:
+    """
+    Writes each DataFrame in tables, a dictionary of file name to
+    DataFrame, to a staging directory, hashing it as it is written, and
+    publishes it as output_dir/current (see publish). Returns the
+    manifest with the rows, bytes and hash of each file. With
+    sorted_output, the tables in sorted_tables are sorted by their keys
+    and each gets a sidecar index, e.g. stop_times_index.csv.
+    """
+
+    stage_dir = staging_dir(output_dir)
+    try:
+        files = []
+        for file_name, df in tables.items():
+            path = stage_dir / file_name
+            if sorted_output and file_name in sorted_tables:
+                columns = sorted_tables[file_name]
+                df = sort_rows(df, columns)
+                digest, index = write_indexed_csv(df, path, columns[0])
+                files.append((file_name, len(df), digest))
+                index_name = f"{Path(file_name).stem}_index.csv"
+                files.append(
+                    (index_name, len(index), write_csv(index, stage_dir / index_name))
+                )
+            else:
+                files.append((file_name, len(df), write_csv(df, path)))
+        rows = [
+            {
+                "file": file_name,
+                "rows": count,
+                "bytes": (stage_dir / file_name).stat().st_size,
+                "hash": digest,
+            }
+            for file_name, count, digest in files
+        ]
+        manifest = pd.DataFrame(rows, columns=manifest_columns)
+        publish(stage_dir, output_dir, manifest, logger)
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    return manifest
@@ -142,3 +142,13 @@ class GTFS_Schema(object):
     calendar_columns = list(Calendar.__annotations__.keys())
     calendar_dates_columns = list(Calendar_Dates.__annotations__.keys())
     shapes_columns = list(Shapes.__annotations__.keys())
+    models = {
+        "agency": Agency,
+        "stops": Stops,
+        "routes": Routes,
+        "trips": Trips,
+        "stop_times": Stop_Times,
+        "calendar": Calendar,
+        "calendar_dates": Calendar_Dates,
+        "shapes": Shapes,
+    }
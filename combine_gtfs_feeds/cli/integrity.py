@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import pandas as pd
+
+try:
+    from .dtypes import ids_as_text
+except Exception:
+    from dtypes import ids_as_text
+
+# (table, column, [(referenced table, referenced column), ...])
+# every relation is checked against the tables as read. With the drop
+# policy, drops are then applied in this order, so rows that only lose
+# their reference because of an earlier drop are dropped too and
+# reported separately (see check_integrity).
+relations = [
+    ("routes", "agency_id", [("agency", "agency_id")]),
+    ("trips", "route_id", [("routes", "route_id")]),
+    (
+        "trips",
+        "service_id",
+        [("calendar", "service_id"), ("calendar_dates", "service_id")],
+    ),
+    ("trips", "shape_id", [("shapes", "shape_id")]),
+    ("stop_times", "trip_id", [("trips", "trip_id")]),
+    ("stop_times", "stop_id", [("stops", "stop_id")]),
+    ("trips", "trip_id", [("stop_times", "trip_id")]),
+    ("frequencies", "trip_id", [("trips", "trip_id")]),
+    ("stops", "parent_station", [("stops", "stop_id")]),
+]
+
+# optional references are set to null instead of dropping the row
+nullable_references = [("trips", "shape_id"), ("stops", "parent_station")]
+
+report_columns = [
+    "feed",
+    "table",
+    "column",
+    "references",
+    "orphan_rows",
+    "orphan_ids",
+    "sample",
+    "action",
+]
+
+
+def find_orphans(values: pd.Series, references: list) -> pd.Series:
+    """
+    Returns a boolean Series that is True where a non-null value is
+    not found in any of the references. Uses hash-based isin, so it
+    is linear in the number of rows.
+    """
+
+    found = values.isnull()
+    for reference in references:
+        reference = reference.dropna().drop_duplicates()
+        if values.dtype == reference.dtype:
+            found |= values.isin(reference)
+        else:
+            # ids read as numbers in one file and text or float in another
+            found |= ids_as_text(values).isin(ids_as_text(reference))
+    return ~found
+
+
+def reference_values(feed_tables: dict, references: list) -> list:
+    """
+    Returns the referenced columns that are in feed_tables and not empty.
+    """
+
+    return [
+        feed_tables[ref_table][ref_column]
+        for ref_table, ref_column in references
+        if ref_table in feed_tables
+        and ref_column in feed_tables[ref_table].columns
+        and len(feed_tables[ref_table]) > 0
+    ]
+
+
+def report_row(
+    feed: str,
+    table: str,
+    column: str,
+    references: list,
+    values: pd.Series,
+    action: str,
+) -> dict:
+    orphan_ids = pd.unique(values)
+    return {
+        "feed": feed,
+        "table": table,
+        "column": column,
+        "references": ";".join(
+            f"{ref_table}.{ref_column}" for ref_table, ref_column in references
+        ),
+        "orphan_rows": len(values),
+        "orphan_ids": len(orphan_ids),
+        "sample": ";".join(str(i) for i in orphan_ids[:5]),
+        "action": action,
+    }
+
+
+def check_integrity(
+    feed_tables: dict, feed: str, policy: str = "keep", skip: list = []
+) -> pd.DataFrame:
+    """
+    Checks every foreign key relation in a feed's tables and returns a
+    report with the number of orphan rows and ids and a sample of the
+    orphan ids for each relation. Relations are checked against the
+    tables as read, so the orphans reported do not depend on policy.
+    With policy 'drop', orphan rows are then removed from feed_tables
+    (optional references are set to null). Rows whose reference was
+    removed by an earlier drop are removed as well and reported with
+    the action 'dropped with parent' (or 'set to null with parent').
+    Relations in skip, as (table, column) tuples, are not checked.
+    """
+
+    checks = []
+    for table, column, references in relations:
+        if (table, column) in skip:
+            continue
+        df = feed_tables.get(table)
+        if df is None or column not in df.columns or len(df) == 0:
+            continue
+        values = reference_values(feed_tables, references)
+        # missing files are handled when the feed is read
+        if len(values) == 0:
+            continue
+        orphans = find_orphans(df[column], values)
+        checks.append((table, column, references, orphans))
+
+    nullable = {True: "set to null", False: "dropped"}
+    rows = []
+    for table, column, references, orphans in checks:
+        if orphans.any():
+            df = feed_tables[table]
+            action = "kept"
+            if policy == "drop":
+                action = nullable[(table, column) in nullable_references]
+            rows.append(
+                report_row(
+                    feed, table, column, references, df.loc[orphans, column], action
+                )
+            )
+
+    if policy == "drop":
+        for table, column, references, orphans in checks:
+            df = feed_tables[table]
+            # orphans of the tables as they are after the earlier drops
+            current = find_orphans(
+                df[column], reference_values(feed_tables, references)
+            )
+            if not current.any():
+                continue
+            cascaded = current & ~orphans.reindex(df.index, fill_value=False)
+            is_nullable = (table, column) in nullable_references
+            if cascaded.any():
+                rows.append(
+                    report_row(
+                        feed,
+                        table,
+                        column,
+                        references,
+                        df.loc[cascaded, column],
+                        nullable[is_nullable] + " with parent",
+                    )
+                )
+            if is_nullable:
+                df = df.copy()
+                df.loc[current, column] = None
+            else:
+                df = df[~current]
+            feed_tables[table] = df
+
+    return pd.DataFrame(rows, columns=report_columns)
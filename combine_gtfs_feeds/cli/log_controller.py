@@ -1,19 +1,25 @@
 import logging
+from logging.handlers import RotatingFileHandler
 from functools import wraps
 from time import time
 import datetime
 import os, sys, errno
-import yaml
 import shutil
 from shutil import copy2 as shcopy
 
+# run_log.txt rolls over to run_log.txt.1 at this size, so long running
+# commands such as watch do not grow it without bound
+max_log_bytes = 10 * 1024**2
+
 
 def setup_custom_logger(name, output_dir):
-    if os.path.exists(os.path.join(output_dir, "run_log.txt")):
-        os.remove(os.path.join(output_dir, "run_log.txt"))
+    log_file = os.path.join(output_dir, "run_log.txt")
+    for path in [log_file, log_file + ".1"]:
+        if os.path.exists(path):
+            os.remove(path)
 
     logging.basicConfig(
-        filename=os.path.join(output_dir, "run_log.txt"),
+        handlers=[RotatingFileHandler(log_file, maxBytes=max_log_bytes, backupCount=1)],
         format="%(asctime)s %(message)s",
         datefmt="%m/%d/%Y %I:%M:%S %p",
     )
@@ -1,19 +1,51 @@
+import importlib
 import sys
 
 from combine_gtfs_feeds.cli import CLI # type: ignore
-from combine_gtfs_feeds.cli import run # type: ignore
+from combine_gtfs_feeds.cli import arguments # type: ignore
 
 
 from combine_gtfs_feeds import __version__, __doc__
 
 
+def lazy_command(module_name, func_name):
+    """
+    Returns a sub-command function that imports its module when it
+    is called, so heavy dependencies only load for the command run.
+    """
+
+    def exec_func(args):
+        module = importlib.import_module(f"combine_gtfs_feeds.cli.{module_name}")
+        return getattr(module, func_name)(args)
+
+    return exec_func
+
+
 def main():
     combine = CLI(version=__version__, description=__doc__)
     combine.add_subcommand(
         name="run",
-        args_func=run.add_run_args,
-        exec_func=run.run,
-        description=run.run.__doc__,
+        args_func=arguments.add_run_args,
+        exec_func=lazy_command("run", "run"),
+        description=arguments.run_description,
+    )
+    combine.add_subcommand(
+        name="batch",
+        args_func=arguments.add_batch_args,
+        exec_func=lazy_command("batch", "batch"),
+        description=arguments.batch_description,
+    )
+    combine.add_subcommand(
+        name="watch",
+        args_func=arguments.add_watch_args,
+        exec_func=lazy_command("watch", "watch"),
+        description=arguments.watch_description,
+    )
+    combine.add_subcommand(
+        name="diff",
+        args_func=arguments.add_diff_args,
+        exec_func=lazy_command("diff", "diff"),
+        description=arguments.diff_description,
     )
 
     sys.exit(combine.execute())
@@ -3,15 +3,30 @@ from __future__ import annotations
 import combine_gtfs_feeds.cli.log_controller as log_controller  # type: ignore
 
 try:
+    from .accumulator import Feed_Accumulator, parse_memory_limit
+    from .arguments import add_run_args
+    from .checkpoint import Checkpoint, feed_signature
+    from .dtypes import ids_as_text, memory_usage_mb, optimize_dtypes
+    from .export import export_tables
     from .gtfs_schema import GTFS_Schema
+    from .integrity import check_integrity
 except Exception:
+    from accumulator import Feed_Accumulator, parse_memory_limit
+    from arguments import add_run_args
+    from checkpoint import Checkpoint, feed_signature
+    from dtypes import ids_as_text, memory_usage_mb, optimize_dtypes
+    from export import export_tables
     from gtfs_schema import GTFS_Schema
+    from integrity import check_integrity
 
 import argparse
 import os as os
+import re
 import sys
 import time
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -22,13 +37,16 @@ import pandas as pd
 class Combined_GTFS:
     file_list = ["agency", "trips", "stop_times", "stops", "routes", "shapes"]
 
-    def __init__(self, df_dict: dict, output_dir: str):
+    def __init__(self, df_dict: dict, output_dir: str, integrity_report=None):
         """
         Initializes the Combined_GTFS class with the provided dataframes and output directory.
         """
 
         # self.agency_df = df_dict["agency"]
         self.output_dir = output_dir
+        self.integrity_report = integrity_report
+        # route_stats and stop_stats, see summary.service_summary
+        self.summary_tables = {}
         self.agency_df = GTFS_Schema.Agency.validate(df_dict["agency"])
         self.agency_df = self.agency_df[
             [col for col in GTFS_Schema.agency_columns if col in self.agency_df.columns]
@@ -78,51 +96,101 @@ class Combined_GTFS:
             ]
         ]
 
-    def export_feed(self):
+    def export_feed(self, sorted_output=False):
         """
-        Exports the combined GTFS feed to the output directory.
+        Exports the combined GTFS feed to the current directory in the
+        output directory, which is replaced as a whole once the export is
+        complete, see export_tables. manifest.csv lists the hash of each
+        file and unchanged files are linked from the previous export. With
+        sorted_output, stop_times and shapes are sorted by trip/shape and
+        sequence and indexed by trip_id/shape_id.
         """
-        dir = Path(self.output_dir)
-        self.agency_df.to_csv(dir / "agency.txt", index=None)
-        self.routes_df.to_csv(dir / "routes.txt", index=None)
-        self.stops_df.to_csv(dir / "stops.txt", index=None)
-        self.stop_times_df.to_csv(dir / "stop_times.txt", index=None)
-        self.shapes_df.to_csv(dir / "shapes.txt", index=None)
-        self.trips_df.to_csv(dir / "trips.txt", index=None)
-        self.calendar_df.to_csv(dir / "calendar.txt", index=None)
-
-
-def add_run_args(parser, multiprocess=True):
-    """
-    Run command args
-    """
-    parser.add_argument(
-        "-g",
-        "--gtfs_dir",
-        type=str,
-        metavar="PATH",
-        help="path to GTFS dir (default: %s)" % os.getcwd(),
-    )
+        tables = {
+            "agency.txt": self.agency_df,
+            "routes.txt": self.routes_df,
+            "stops.txt": self.stops_df,
+            "stop_times.txt": self.stop_times_df,
+            "shapes.txt": self.shapes_df,
+            "trips.txt": self.trips_df,
+            "calendar.txt": self.calendar_df,
+        }
+        if self.integrity_report is not None:
+            tables["integrity_report.csv"] = self.integrity_report
+        for name, df in self.summary_tables.items():
+            tables[f"{name}.csv"] = df
+        return export_tables(
+            tables,
+            self.output_dir,
+            log_controller.logging.getLogger("main_logger"),
+            sorted_output,
+        )
+
+
+def get_time_window(start_time=None, end_time=None, time_rule="starts"):
+    """
+    Returns a (start_secs, end_secs, time_rule) tuple for the
+    user parameters start_time and end_time in hh:mm:ss format,
+    or None if neither is given. Raises ValueError if a time is
+    not in hh:mm:ss format or start_time is not before end_time.
+    As in GTFS, a window that runs past midnight ends after
+    24:00:00, e.g. 22:00:00 to 26:00:00.
+    """
 
-    parser.add_argument(
-        "-s",
-        "--service_date",
-        type=int,
-        metavar="SERVICEDATE",
-        help=(
-            "date for service in yyyymmdd integer format                      "
-            " (default: %s)"
+    if start_time is None and end_time is None:
+        return None
+    for value in [start_time, end_time]:
+        if value and not re.fullmatch(r"\d+:[0-5]\d:[0-5]\d", str(value).strip()):
+            raise ValueError(f"Invalid time {value}, expected HH:MM:SS")
+    start_secs = convert_to_seconds(str(start_time)) if start_time else 0
+    end_secs = convert_to_seconds(str(end_time)) if end_time else np.inf
+    if start_secs >= end_secs:
+        raise ValueError(
+            f"start_time {start_time or '00:00:00'} must be before end_time"
+            f" {end_time}. For a window that runs past midnight, use an"
+            " end_time after 24:00:00, e.g. 22:00:00 to 26:00:00"
         )
-        % os.getcwd(),
-    )
+    return start_secs, end_secs, time_rule
 
-    parser.add_argument(
-        "-o",
-        "--output_dir",
-        type=str,
-        metavar="PATH",
-        help="path to ourput directory (default: %s)" % os.getcwd(),
-    )
+
+def get_route_filter(agencies=None, route_types=None, routes=None):
+    """
+    Returns a dictionary of the user parameters agencies, route_types
+    and routes, or None if none of them are given.
+    """
+
+    if not (agencies or route_types or routes):
+        return None
+    return {"agencies": agencies, "route_types": route_types, "routes": routes}
+
+
+def select_routes(
+    routes: pd.DataFrame, agency: pd.DataFrame, feed: str, route_filter: dict
+) -> pd.DataFrame:
+    """
+    Returns the routes of a feed that are selected by route_filter.
+    """
+
+    keep = pd.Series(True, index=routes.index)
+    if route_filter["agencies"]:
+        agencies = [str(i) for i in route_filter["agencies"]]
+        selected = pd.Series(False, index=agency.index)
+        for col in ["agency_id", "agency_name"]:
+            if col in agency.columns:
+                selected |= agency[col].astype(str).isin(agencies)
+        if "agency_id" in routes.columns and "agency_id" in agency.columns:
+            agency_ids = agency.loc[selected, "agency_id"].astype(str)
+            keep &= routes["agency_id"].astype(str).isin(agency_ids)
+        else:
+            # routes without agency_id belong to the feed's only agency
+            keep &= selected.any()
+    if route_filter["route_types"]:
+        keep &= routes["route_type"].isin(route_filter["route_types"])
+    if route_filter["routes"]:
+        route_ids = [str(i) for i in route_filter["routes"]]
+        keep &= routes["route_id"].astype(str).isin(route_ids) | (
+            feed + "_" + routes["route_id"].astype(str)
+        ).isin(route_ids)
+    return routes[keep]
 
 
 def get_service_ids(
@@ -184,6 +252,19 @@ def dt_to_yyyymmdd(dt_time: datetime) -> int:
     return 10000 * dt_time.year + 100 * dt_time.month + dt_time.day
 
 
+def get_service_date(service_date) -> datetime:
+    """
+    Converts the user parameter service_date
+    in YYYYMMDD format to a date time object.
+    """
+    str_service_date = str(service_date)
+    return datetime(
+        int(str_service_date[0:4]),
+        int(str_service_date[4:6]),
+        int(str_service_date[6:8]),
+    )
+
+
 def get_start_end_date(my_date: datetime) -> tuple[int, int]:
     """
     Gets the day before and after
@@ -221,6 +302,16 @@ def convert_to_seconds(value: str) -> int:
     return int(h) * 3600 + int(m) * 60 + int(s)
 
 
+def time_to_seconds(times: pd.Series) -> pd.Series:
+    """
+    Vectorized version of convert_to_seconds. Missing or malformed
+    times are returned as NaN.
+    """
+    parts = times.astype("string").str.extract(r"^\s*(\d+):(\d+):(\d+)\s*$")
+    parts = parts.astype(float)
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
 def to_hhmmss(value: float) -> str:
     """
     Converts to hhmmss format.
@@ -248,14 +339,114 @@ def interpolate_arrival_departure_time(stop_times: pd.DataFrame) -> pd.DataFrame
     return stop_times
 
 
+def get_trip_spans(stop_times: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns a DataFrame indexed by trip_id with the first departure
+    (first_secs) and last arrival (last_secs) of each trip in seconds
+    after midnight.
+    """
+
+    departure_secs = time_to_seconds(stop_times["departure_time"])
+    arrival_secs = time_to_seconds(stop_times["arrival_time"])
+    spans = pd.DataFrame(
+        {
+            "trip_id": stop_times["trip_id"].values,
+            "first_secs": departure_secs.fillna(arrival_secs).values,
+            "last_secs": arrival_secs.fillna(departure_secs).values,
+        }
+    )
+    return spans.groupby("trip_id").agg({"first_secs": "min", "last_secs": "max"})
+
+
+def in_time_window(
+    first_secs, last_secs, start_secs: int, end_secs: int, time_rule: str
+):
+    """
+    Returns True where a trip running from first_secs to last_secs is
+    kept by the time window [start_secs, end_secs). With time_rule
+    'starts' the trip must start in the window, with 'touches' any
+    part of the trip must fall in the window.
+    """
+
+    if time_rule == "starts":
+        return (first_secs >= start_secs) & (first_secs < end_secs)
+    return (first_secs < end_secs) & (last_secs >= start_secs)
+
+
+def filter_time_window(
+    trips: pd.DataFrame,
+    stop_times: pd.DataFrame,
+    time_window: tuple,
+    keep_trip_ids=[],
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Removes trips, and their stop_times, that are outside of
+    time_window, a tuple of (start_secs, end_secs, time_rule). Trips
+    in keep_trip_ids and trips without any times are always kept.
+    """
+
+    spans = get_trip_spans(stop_times)
+    keep = in_time_window(spans["first_secs"], spans["last_secs"], *time_window)
+    keep = keep | spans["first_secs"].isnull() | spans.index.isin(keep_trip_ids)
+    drop_trip_ids = spans.index[~keep]
+
+    trips = trips[~trips["trip_id"].isin(drop_trip_ids)]
+    stop_times = stop_times[~stop_times["trip_id"].isin(drop_trip_ids)]
+    return trips, stop_times
+
+
+def trim_frequencies(
+    frequencies: pd.DataFrame, stop_times: pd.DataFrame, time_window: tuple
+) -> pd.DataFrame:
+    """
+    Limits each row of frequencies.txt to the headways that create
+    trips inside time_window, so trips outside of the window are never
+    generated. start_time_secs, total_trips and counter_offset are
+    updated so the remaining trips keep the times and trip_ids they
+    would have without the window.
+    """
+
+    start_secs, end_secs, time_rule = time_window
+    if time_rule == "starts":
+        duration = 0
+    else:
+        spans = get_trip_spans(stop_times)
+        duration = (
+            frequencies["trip_id"]
+            .map(spans["last_secs"] - spans["first_secs"])
+            .fillna(0)
+            .values
+        )
+
+    headway = frequencies["headway_secs"].values
+    # first and last headway (k) with start_time_secs + k * headway_secs
+    # inside the window
+    first_k = np.ceil(
+        (start_secs - duration - frequencies["start_time_secs"].values) / headway
+    ).clip(min=0)
+    last_k = np.minimum(
+        frequencies["total_trips"].values - 1,
+        np.ceil((end_secs - frequencies["start_time_secs"].values) / headway) - 1,
+    )
+    first_k = first_k.astype(int)
+    frequencies["start_time_secs"] = frequencies["start_time_secs"] + first_k * headway
+    frequencies["counter_offset"] = frequencies["counter_offset"] + first_k
+    frequencies["total_trips"] = np.maximum(last_k - first_k + 1, 0).astype(int)
+    return frequencies
+
+
 def frequencies_to_trips(
-    frequencies: pd.DataFrame, trips: pd.DataFrame, stop_times: pd.DataFrame
+    frequencies: pd.DataFrame,
+    trips: pd.DataFrame,
+    stop_times: pd.DataFrame,
+    time_window=None,
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     For each trip_id in frequencies.txt, calculates the number
     of trips and creates records for each trip in trips.txt and
     stop_times.txt. Deletes the original represetative trip_id
-    in both of these files.
+    in both of these files. If time_window is given, only trips
+    inside the window are created.
     """
 
     # some feeds will use the same trip_id for multiple rows
@@ -286,11 +477,25 @@ def frequencies_to_trips(
         .astype(int)
     )
 
+    # number of trips created by earlier rows for the same trip_id,
+    # used to number trips consistently across rows
+    frequencies["counter_offset"] = (
+        frequencies.groupby("trip_id")["total_trips"].cumsum()
+        - frequencies["total_trips"]
+    )
+
+    if time_window is not None:
+        frequencies = trim_frequencies(frequencies, stop_times, time_window)
+
     trips_update = trips.merge(frequencies, on="trip_id")
     trips_update = trips_update.loc[
         trips_update.index.repeat(trips_update["total_trips"])
     ].reset_index(drop=True)
-    trips_update["counter"] = trips_update.groupby("trip_id").cumcount() + 1
+    trips_update["counter"] = (
+        trips_update["counter_offset"]
+        + trips_update.groupby("frequency_id").cumcount()
+        + 1
+    )
     trips_update["trip_id"] = (
         trips_update["trip_id"].astype(str) + "_" + trips_update["counter"].astype(str)
     )
@@ -332,9 +537,9 @@ def frequencies_to_trips(
         stop_times_update["counter"] * stop_times_update["headway_secs"]
     )
 
-    # now we want to get the cumcount based on trip_id
+    # now we want the trip number based on trip_id
     stop_times_update["counter"] = (
-        stop_times_update.groupby(["trip_id", "stop_id"]).cumcount() + 1
+        stop_times_update["counter_offset"] + stop_times_update["counter"] + 1
     )
     stop_times_update["departure_time"] = stop_times_update[
         "departure_time_secs"
@@ -439,12 +644,19 @@ def shapes_from_stops_sequence(
 ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
     Used when shapes.txt is missing. Creates a new shapes.txt file
-    using the stop_sequence from stop_times.txt.
+    using the stop_sequence from stop_times.txt. If stop_times is
+    empty, e.g. no trips are in the time window, shapes and trips
+    are returned empty.
     """
 
     trip_cols = list(trips.columns)
     if "shape_id" not in trip_cols:
         trip_cols.append("shape_id")
+    if len(stop_times) == 0:
+        shapes = pd.DataFrame(
+            columns=["shape_pt_lat", "shape_pt_lon", "shape_pt_sequence", "shape_id"]
+        )
+        return shapes, trips.iloc[0:0].reindex(columns=trip_cols)
     merged = stop_times.merge(stops, how="left", on="stop_id")
     merged = merged.merge(trips, how="left", on="trip_id")
     schedule_pattern = get_schedule_pattern(merged)
@@ -472,6 +684,44 @@ def shapes_from_stops_sequence(
     return shapes, new_trips
 
 
+def read_csv(source, row_filter=None, chunksize=1000000) -> tuple[pd.DataFrame, int]:
+    """
+    Reads a csv file and returns it and the number of rows in the file.
+    If row_filter, a tuple of (column, values), is given the file is
+    read in chunks and only rows where column is in values are kept,
+    so the whole file is never held in memory.
+    """
+
+    if row_filter is None:
+        df = pd.read_csv(source)
+        return df, len(df)
+
+    chunks = []
+    rows = 0
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        rows += len(chunk)
+        chunk.columns = chunk.columns.str.replace(" ", "")
+        chunks.append(filter_rows(chunk, row_filter))
+    return pd.concat(chunks, ignore_index=True), rows
+
+
+def filter_rows(df: pd.DataFrame, row_filter=None) -> pd.DataFrame:
+    """
+    Returns the rows of df where column is in values for row_filter, a
+    tuple of (column, values). Values are compared as text with
+    ids_as_text, so ids read as numbers in one file and text or float
+    in another still match.
+    """
+
+    if row_filter is None:
+        return df
+    column, values = row_filter
+    if column not in df.columns:
+        return df
+    values = pd.unique(ids_as_text(pd.Series(values)).dropna())
+    return df[ids_as_text(df[column]).isin(values)]
+
+
 def read_gtfs(
     path: Path,
     gtfs_file_name: str,
@@ -479,29 +729,34 @@ def read_gtfs(
     feed_name: str,
     logger: log_controller.logging.Logger,
     empty_df_cols=[],
+    row_filter=None,
 ) -> pd.DataFrame:
     """
-    Reads in a GTFS file and returns a DataFrame.
+    Reads in a GTFS file and returns a DataFrame. See read_csv
+    for row_filter.
     """
 
     if is_zipped:
         zf = zipfile.ZipFile(path.with_suffix(".zip"))
         try:
             # df = pd.read_csv(zf.open(gtfs_file_name), dtype_backend="pyarrow")
-            df = pd.read_csv(zf.open(gtfs_file_name))
-            if df.empty:
+            df, file_rows = read_csv(zf.open(gtfs_file_name), row_filter)
+            # rows removed by row_filter do not make the file empty
+            if file_rows == 0:
                 if feed_name in GTFS_Schema.required_files:
-                    logger(
+                    logger.info(
                         f"Fatal! {gtfs_file_name} from feed {feed_name} is empty."
                         " Exiting program"
                     )
                     sys.exit()
 
                 else:
-                    logger(f"Warning! {gtfs_file_name} from feed {feed_name} is empty.")
+                    logger.info(
+                        f"Warning! {gtfs_file_name} from feed {feed_name} is empty."
+                    )
         except Exception:
             if gtfs_file_name in GTFS_Schema.required_files:
-                logger(
+                logger.info(
                     f"Fatal! {gtfs_file_name} from feed {feed_name} is missing. Exiting"
                     " program"
                 )
@@ -513,8 +768,9 @@ def read_gtfs(
     else:
         try:
             # df = pd.read_csv(path / gtfs_file_name, dtype_backend="pyarrow")
-            df = pd.read_csv(path / gtfs_file_name)
-            if df.empty:
+            df, file_rows = read_csv(path / gtfs_file_name, row_filter)
+            # rows removed by row_filter do not make the file empty
+            if file_rows == 0:
                 if feed_name in GTFS_Schema.required_files:
                     logger.info(
                         f"Fatal! {gtfs_file_name} from feed {feed_name} is empty."
@@ -523,7 +779,9 @@ def read_gtfs(
                     sys.exit()
 
                 else:
-                    logger(f"Warning! {gtfs_file_name} from feed {feed_name} is empty.")
+                    logger.info(
+                        f"Warning! {gtfs_file_name} from feed {feed_name} is empty."
+                    )
         except Exception:
             if gtfs_file_name in GTFS_Schema.required_files:
                 logger.info(
@@ -539,185 +797,395 @@ def read_gtfs(
     return df
 
 
-def run(args: argparse.Namespace) -> None:
+def get_feed_list(gtfs_dir: Path) -> tuple[list, bool]:
     """
-    Implements the 'run' sub-command, which combines
-    gtfs files from each feed and writes them out to
-    a single feed.
+    Returns the names of the feeds in gtfs_dir and whether they are
+    zipped. Each sub directory is a feed; if there are none, each .zip
+    file is a feed and its name is returned without the extension.
     """
 
-    logger = log_controller.setup_custom_logger("main_logger", args.output_dir)
-    logger.info("------------------combine_gtfs_feeds Started----------------")
+    feed_list = next(os.walk(gtfs_dir))[1]
+    if len(feed_list) == 0:
+        feed_list = next(os.walk(gtfs_dir))[2]
+        feed_list = [i[:-4] for i in feed_list if ".zip" in i]
+        zipped = True
+    else:
+        zipped = False
+    return feed_list, zipped
 
-    feeds = combine(args.gtfs_dir, args.service_date, args.output_dir, logger)
 
-    feeds.export_feed()
+def read_feed(
+    path: Path,
+    is_zipped: bool,
+    feed_name: str,
+    logger: log_controller.logging.Logger,
+    route_filter=None,
+    optimize=False,
+) -> dict:
+    """
+    Reads all GTFS files used by combine for a single feed and
+    returns them in a dictionary keyed by file name (without .txt).
+    If route_filter (see get_route_filter) is given, routes.txt is
+    read first and only rows that belong to the selected routes are
+    kept while reading the other files. If optimize is True, dtypes are
+    downcast with optimize_feed.
+    """
 
-    logger.info("Finished running combine_gtfs_feeds")
-    sys.exit()
-    # print("Finished running combine_gtfs_feeds")
+    feed_tables = {}
+    feed_tables["calendar"] = read_gtfs(
+        path, "calendar.txt", is_zipped, feed_name, logger
+    )
+    feed_tables["calendar_dates"] = read_gtfs(
+        path,
+        "calendar_dates.txt",
+        is_zipped,
+        feed_name,
+        logger,
+        ["service_id", "date", "exception_type"],
+    )
+    if route_filter is None:
+        for file_name in [
+            "trips",
+            "stops",
+            "stop_times",
+            "frequencies",
+            "routes",
+            "shapes",
+            "agency",
+        ]:
+            feed_tables[file_name] = read_gtfs(
+                path, f"{file_name}.txt", is_zipped, feed_name, logger
+            )
+    else:
+        read_filtered_feed(
+            feed_tables, path, is_zipped, feed_name, logger, route_filter
+        )
+
+    if optimize:
+        optimize_feed(feed_tables, feed_name, logger)
+    return feed_tables
 
 
-def combine(gtfs_dir: str, service_date, output_dir, logger=None) -> Combined_GTFS:
+def read_filtered_feed(
+    feed_tables: dict,
+    path: Path,
+    is_zipped: bool,
+    feed_name: str,
+    logger: log_controller.logging.Logger,
+    route_filter: dict,
+) -> None:
     """
-    Combines GTFS feeds from each feed and writes them out to a single feed.
+    Adds the GTFS files of a feed that belong to the routes selected by
+    route_filter to feed_tables. Rows of other routes are dropped while
+    each file is read.
     """
-    if not logger:
-        logger = log_controller.setup_custom_logger("main_logger", output_dir)
-        logger.info("------------------combine_gtfs_feeds Started----------------")
-    output_loc = output_dir
 
-    if not os.path.isdir(output_loc):
-        print("Output Directory path : {} does not exist.".format(output_loc))
-        print("Exiting application early!")
-        sys.exit()
+    def read_filtered(file_name, row_filter=None):
+        return read_gtfs(
+            path,
+            f"{file_name}.txt",
+            is_zipped,
+            feed_name,
+            logger,
+            row_filter=row_filter,
+        )
 
-    dir = Path(gtfs_dir)
-    str_service_date = str(service_date)
-    my_date = datetime(
-        int(str_service_date[0:4]),
-        int(str_service_date[4:6]),
-        int(str_service_date[6:8]),
-    )
+    feed_tables.update(filter_feed(read_filtered, feed_name, route_filter))
 
-    logger.info("GTFS Directory path is: {}".format(dir))
-    logger.info("Output Directory path is: {}".format(output_loc))
-    logger.info("Service Date is: {}".format(str_service_date))
 
-    if not os.path.isdir(dir):
-        logger.info("GTFS Directory path : {} does not exist.".format(dir))
-        logger.info("Exiting application early!")
-        sys.exit()
+def filter_feed(read_filtered, feed_name: str, route_filter: dict) -> dict:
+    """
+    Returns the tables of a feed that belong to the routes selected by
+    route_filter. read_filtered(file_name, row_filter) returns a table
+    with the rows selected by row_filter (see filter_rows). Files that
+    reference routes are read in the order that lets each one be
+    filtered as it is read. If no routes are selected, only agency and
+    routes are returned.
+    """
 
-    start_date, end_date = get_start_end_date(my_date)
-    day_of_week = get_weekday(my_date)
-    feed_list = next(os.walk(dir))[1]
-    if len(feed_list) == 0:
-        feed_list = next(os.walk(dir))[2]
-        feed_list = [i for i in feed_list if ".zip" in i]
-        zipped = True
-    else:
-        zipped = False
-    feed_dict = {}
+    feed_tables = {}
+    agency = read_filtered("agency")
+    routes = read_filtered("routes")
+    routes = select_routes(routes, agency, feed_name, route_filter)
+    if "agency_id" in routes.columns and "agency_id" in agency.columns:
+        agency = agency[agency["agency_id"].isin(routes["agency_id"])]
+    feed_tables["agency"] = agency
+    feed_tables["routes"] = routes
+    # the feed is skipped by process_feed, so the other files are not read
+    if len(routes) == 0:
+        return feed_tables
+
+    trips = read_filtered("trips", ("route_id", routes["route_id"]))
+    feed_tables["trips"] = trips
+    feed_tables["stop_times"] = read_filtered(
+        "stop_times", ("trip_id", trips["trip_id"])
+    )
+    feed_tables["frequencies"] = read_filtered(
+        "frequencies", ("trip_id", trips["trip_id"])
+    )
+    feed_tables["stops"] = read_filtered(
+        "stops", ("stop_id", feed_tables["stop_times"]["stop_id"])
+    )
+    shape_ids = trips["shape_id"] if "shape_id" in trips.columns else []
+    feed_tables["shapes"] = read_filtered("shapes", ("shape_id", shape_ids))
+    return feed_tables
 
-    if len(feed_list) == 0:
-        logger.info("There are no GTFS feeds in GTFS Directory path : {}.".format(dir))
-        logger.info("Exiting application early!")
-        sys.exit()
 
-    for feed in feed_list:
-        if zipped:
-            feed = feed[:-4]
-        feed_dict[feed] = {}
-        # read data
-        full_path = dir / feed
-        calendar = read_gtfs(full_path, "calendar.txt", zipped, feed, logger)
-        calendar_dates = read_gtfs(
-            full_path,
-            "calendar_dates.txt",
-            zipped,
-            feed,
-            logger,
-            ["service_id", "date", "exception_type"],
-        )
+def optimize_feed(
+    feed_tables: dict, feed_name: str, logger: log_controller.logging.Logger
+) -> None:
+    """
+    Downcasts the dtypes of each table in feed_tables and logs the
+    memory used by each table and by the feed before and after.
+    """
 
-        service_id_list = get_service_ids(
-            calendar, calendar_dates, day_of_week, service_date
+    feed_before = 0
+    feed_after = 0
+    for file_name, df in feed_tables.items():
+        before = memory_usage_mb(df)
+        feed_tables[file_name] = optimize_dtypes(df, file_name)
+        after = memory_usage_mb(feed_tables[file_name])
+        feed_before += before
+        feed_after += after
+        logger.info(
+            f"{file_name}.txt from feed {feed_name} uses {after:.1f} MB,"
+            f" {before:.1f} MB before optimizing dtypes"
         )
+    logger.info(
+        f"Feed {feed_name} uses {feed_after:.1f} MB, {feed_before:.1f} MB before"
+        " optimizing dtypes"
+    )
 
-        if len(service_id_list) == 0:
-            logger.info(
-                "There are no service ids for service                 date {}...".format(
-                    str_service_date
-                )
+
+def prefetch_feeds(
+    gtfs_dir: Path,
+    feed_list: list,
+    is_zipped: bool,
+    logger: log_controller.logging.Logger,
+    prefetch_depth: int = 2,
+    route_filter=None,
+    optimize=False,
+    feed_reader=None,
+):
+    """
+    Yields (feed, feed_tables) for each feed in feed_list, in order.
+    Up to prefetch_depth feeds are read and parsed on a background
+    thread pool while the caller processes the current feed, so disk
+    and network reads overlap with processing. Memory is bounded to
+    the current feed plus prefetch_depth feeds in flight. feed_reader
+    replaces read_feed, with the same arguments.
+    """
+
+    if feed_reader is None:
+        feed_reader = read_feed
+
+    if prefetch_depth < 1:
+        for feed in feed_list:
+            yield feed, feed_reader(
+                gtfs_dir / feed, is_zipped, feed, logger, route_filter, optimize
             )
-            logger.info("for feed {}".format(feed))
-            logger.info("Exiting application early!")
-            sys.exit()
+        return
+
+    feeds = iter(feed_list)
+    pending = deque()
+    with ThreadPoolExecutor(
+        max_workers=prefetch_depth, thread_name_prefix="gtfs_prefetch"
+    ) as executor:
+
+        def submit_next():
+            feed = next(feeds, None)
+            if feed is not None:
+                pending.append(
+                    (
+                        feed,
+                        executor.submit(
+                            feed_reader,
+                            gtfs_dir / feed,
+                            is_zipped,
+                            feed,
+                            logger,
+                            route_filter,
+                            optimize,
+                        ),
+                    )
+                )
+
+        for _ in range(prefetch_depth):
+            submit_next()
 
-        for id in service_id_list:
-            logger.info("Adding service_id {} for feed {}".format(id, feed))
+        try:
+            while pending:
+                feed, future = pending.popleft()
+                feed_tables = future.result()
+                submit_next()
+                yield feed, feed_tables
+        finally:
+            # stop reading ahead if the caller exits early
+            for _, future in pending:
+                future.cancel()
+
+
+def process_feed(
+    feed: str,
+    feed_tables: dict,
+    service_date,
+    day_of_week: str,
+    logger: log_controller.logging.Logger,
+    time_window=None,
+    route_filter=None,
+    orphans="keep",
+) -> tuple:
+    """
+    Processes the tables of a single feed for combine: checks their
+    references, keeps the trips that run on service_date (and in
+    time_window), expands frequencies, creates missing shapes and
+    prefixes ids with the feed name. Returns a dictionary of the
+    tables in Combined_GTFS.file_list and the integrity report, or
+    (None, None) if route_filter selects no routes from the feed.
+    """
 
-        trips = read_gtfs(full_path, "trips.txt", zipped, feed, logger)
-        stops = read_gtfs(full_path, "stops.txt", zipped, feed, logger)
-        stop_times = read_gtfs(full_path, "stop_times.txt", zipped, feed, logger)
-        frequencies = read_gtfs(full_path, "frequencies.txt", zipped, feed, logger)
+    if route_filter is not None and len(feed_tables["routes"]) == 0:
+        logger.info(f"No routes selected from feed {feed}, skipping feed")
+        return None, None
 
-        if len(frequencies) > 0:
-            logger.info(f"Feed {feed} contains frequencies.txt...".format(feed))
+    # stops are only read for the selected routes, so their
+    # parent stations may be left out
+    skip_relations = [("stops", "parent_station")] if route_filter else []
+    report = check_integrity(feed_tables, feed, orphans, skip_relations)
+    for row in report.itertuples():
+        if row.action.endswith("with parent"):
             logger.info(
-                "Unique trips will be added to outputs based on headways in"
-                " frequencies.txt"
+                f"Warning! {row.orphan_rows} rows in {row.table}.txt from feed"
+                f" {feed} reference {row.orphan_ids} {row.column}(s) of rows"
+                f" dropped from {row.references}, rows {row.action}"
             )
-            trips, stop_times = frequencies_to_trips(frequencies, trips, stop_times)
+            continue
+        logger.info(
+            f"Warning! {row.orphan_rows} rows in {row.table}.txt from feed"
+            f" {feed} reference {row.orphan_ids} {row.column}(s) not found"
+            f" in {row.references}, orphan rows {row.action}"
+        )
 
-        routes = read_gtfs(full_path, "routes.txt", zipped, feed, logger)
-        shapes = read_gtfs(full_path, "shapes.txt", zipped, feed, logger)
-        agency = read_gtfs(full_path, "agency.txt", zipped, feed, logger)
-        if "agency_id" not in routes.columns:
-            routes["agency_id"] = agency["agency_id"][0]
+    calendar = feed_tables["calendar"]
+    calendar_dates = feed_tables["calendar_dates"]
 
-        # check to make sure there are shapes
-        if len(shapes) == 0:
-            logger.info(
-                f"Warning: feed {feed} is mising shapes.txt. Records for this file will"
-                " be created using route-level unique stop sequence and location. See"
-                " documentation for more information."
+    service_id_list = get_service_ids(
+        calendar, calendar_dates, day_of_week, service_date
+    )
+
+    if len(service_id_list) == 0:
+        logger.info(
+            "There are no service ids for service                 date {}...".format(
+                service_date
             )
-            shapes, trips = shapes_from_stops_sequence(stops, stop_times, trips)
-            # trips = create_id(trips, feed, "shape_id")
+        )
+        logger.info("for feed {}".format(feed))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    for id in service_id_list:
+        logger.info("Adding service_id {} for feed {}".format(id, feed))
 
-        # create new IDs
-        trips = create_id(trips, feed, "trip_id")
-        trips = create_id(trips, feed, "route_id")
-        trips = create_id(trips, feed, "shape_id")
+    trips = feed_tables["trips"]
+    stops = feed_tables["stops"]
+    stop_times = feed_tables["stop_times"]
+    frequencies = feed_tables["frequencies"]
 
-        shapes = create_id(shapes, feed, "shape_id")
+    if time_window is not None:
+        # trips in frequencies.txt are templates, their trips are
+        # filtered when they are created
+        frequency_trip_ids = frequencies["trip_id"] if len(frequencies) > 0 else []
+        trips, stop_times = filter_time_window(
+            trips, stop_times, time_window, frequency_trip_ids
+        )
 
-        stop_times = create_id(stop_times, feed, "trip_id")
-        stop_times = create_id(stop_times, feed, "stop_id")
-        stops = create_id(stops, feed, "stop_id")
-        routes = create_id(routes, feed, "route_id")
+    if len(frequencies) > 0:
+        logger.info(f"Feed {feed} contains frequencies.txt...".format(feed))
+        logger.info(
+            "Unique trips will be added to outputs based on headways in"
+            " frequencies.txt"
+        )
+        trips, stop_times = frequencies_to_trips(
+            frequencies, trips, stop_times, time_window
+        )
+        if time_window is not None:
+            trips, stop_times = filter_time_window(trips, stop_times, time_window)
+
+    routes = feed_tables["routes"]
+    shapes = feed_tables["shapes"]
+    agency = feed_tables["agency"]
+    del feed_tables
+    if "agency_id" not in routes.columns:
+        routes["agency_id"] = agency["agency_id"][0]
+
+    # check to make sure there are shapes
+    if len(shapes) == 0:
+        logger.info(
+            f"Warning: feed {feed} is mising shapes.txt. Records for this file will"
+            " be created using route-level unique stop sequence and location. See"
+            " documentation for more information."
+        )
+        shapes, trips = shapes_from_stops_sequence(stops, stop_times, trips)
+        # trips = create_id(trips, feed, "shape_id")
+
+    # create new IDs
+    trips = create_id(trips, feed, "trip_id")
+    trips = create_id(trips, feed, "route_id")
+    trips = create_id(trips, feed, "shape_id")
+
+    shapes = create_id(shapes, feed, "shape_id")
+
+    stop_times = create_id(stop_times, feed, "trip_id")
+    stop_times = create_id(stop_times, feed, "stop_id")
+    stops = create_id(stops, feed, "stop_id")
+    routes = create_id(routes, feed, "route_id")
+
+    # trips
+    trips = trips.loc[trips["service_id"].isin(service_id_list)]
+    if len(trips) == 0:
+        logger.info(
+            f"Warning! No trips found for feed {feed} using service_ids"
+            f" {str(service_id_list)}"
+        )
+    trips["service_id"] = 1
+    trip_id_list = np.unique(trips["trip_id"].tolist())
+    route_id_list = np.unique(trips["route_id"].tolist())
+    shape_id_list = np.unique(trips["shape_id"].tolist())
+
+    # stop times
+    stop_times = stop_times.loc[stop_times["trip_id"].isin(trip_id_list)]
+    if stop_times["departure_time"].isnull().any():
+        logger.info(
+            "Feed {} contains missing departure/arrival times. Interpolating"
+            " missing times.".format(feed)
+        )
+        stop_times = interpolate_arrival_departure_time(stop_times)
+
+    stop_id_list = np.unique(stop_times["stop_id"].tolist())
+    # stops
+    stops = stops.loc[stops["stop_id"].isin(stop_id_list)]
+    # routes
+    routes = routes.loc[routes["route_id"].isin(route_id_list)]
+    routes["route_short_name"].fillna(routes["route_id"], inplace=True)
+    # shapes
+    shapes = shapes.loc[shapes["shape_id"].isin(shape_id_list)]
+
+    return {
+        "agency": agency,
+        "trips": trips,
+        "stop_times": stop_times,
+        "stops": stops,
+        "routes": routes,
+        "shapes": shapes,
+    }, report
+
+
+def get_calendar(day_of_week: str, start_date: int, end_date: int) -> pd.DataFrame:
+    """
+    Returns the calendar of the combined feed, with a single
+    service_id that runs on day_of_week.
+    """
 
-        # trips
-        trips = trips.loc[trips["service_id"].isin(service_id_list)]
-        if len(trips) == 0:
-            logger.info(
-                f"Warning! No trips found for feed {feed} using service_ids"
-                f" {str(service_id_list)}"
-            )
-        trips["service_id"] = 1
-        trip_id_list = np.unique(trips["trip_id"].tolist())
-        route_id_list = np.unique(trips["route_id"].tolist())
-        shape_id_list = np.unique(trips["shape_id"].tolist())
-
-        # stop times
-        stop_times = stop_times.loc[stop_times["trip_id"].isin(trip_id_list)]
-        if stop_times["departure_time"].isnull().any():
-            logger.info(
-                "Feed {} contains missing departure/arrival times. Interpolating"
-                " missing times.".format(feed)
-            )
-            stop_times = interpolate_arrival_departure_time(stop_times)
-
-        stop_id_list = np.unique(stop_times["stop_id"].tolist())
-        # stops
-        stops = stops.loc[stops["stop_id"].isin(stop_id_list)]
-        # routes
-        routes = routes.loc[routes["route_id"].isin(route_id_list)]
-        routes["route_short_name"].fillna(routes["route_id"], inplace=True)
-        # shapes
-        shapes = shapes.loc[shapes["shape_id"].isin(shape_id_list)]
-
-        # pass data to the dictionary
-        feed_dict[feed]["agency"] = agency
-        feed_dict[feed]["trips"] = trips
-        feed_dict[feed]["stop_times"] = stop_times
-        feed_dict[feed]["stops"] = stops
-        feed_dict[feed]["routes"] = routes
-        feed_dict[feed]["shapes"] = shapes
-
-    # calendar
     calendar = pd.DataFrame(
         columns=[
             "service_id",
@@ -738,19 +1206,292 @@ def combine(gtfs_dir: str, service_date, output_dir, logger=None) -> Combined_GT
     calendar[day_of_week] = 1
     calendar["start_date"] = start_date
     calendar["end_date"] = end_date
+    return calendar
+
 
+def merge_feeds(
+    accumulator: Feed_Accumulator,
+    integrity_reports: list,
+    my_date: datetime,
+    logger: log_controller.logging.Logger,
+) -> tuple[dict, pd.DataFrame]:
+    """
+    Returns the combined tables, before validation, built from the
+    processed feeds in accumulator, and the combined integrity report.
+    """
+
+    if len(accumulator) == 0:
+        logger.info("No routes selected from any feed.")
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    start_date, end_date = get_start_end_date(my_date)
     combined_feed_dict = {}
-    combined_feed_dict["calendar"] = calendar
+    combined_feed_dict["calendar"] = get_calendar(
+        get_weekday(my_date), start_date, end_date
+    )
+
+    try:
+        for file_name in Combined_GTFS.file_list:
+            combined_feed_dict[file_name] = accumulator.concat(file_name)
+    finally:
+        accumulator.cleanup()
+
+    integrity_report = pd.concat(integrity_reports, ignore_index=True)
+    return combined_feed_dict, integrity_report
+
+
+def run(args: argparse.Namespace) -> None:
+    """
+    Implements the 'run' sub-command, which combines
+    gtfs files from each feed and writes them out to
+    a single feed.
+    """
 
-    for file_name in Combined_GTFS.file_list:
-        df = pd.DataFrame()
-        for feed in feed_dict:
-            df = pd.concat([df, feed_dict[feed][file_name]])
-        combined_feed_dict[file_name] = df
+    logger = log_controller.setup_custom_logger("main_logger", args.output_dir)
+    logger.info("------------------combine_gtfs_feeds Started----------------")
 
-    # logger.info("Finished running combine_gtfs_feeds")
+    try:
+        time_window = get_time_window(args.start_time, args.end_time, args.time_rule)
+    except ValueError as e:
+        logger.info(str(e))
+        logger.info("Exiting application early!")
+        sys.exit()
+    route_filter = get_route_filter(args.agencies, args.route_types, args.routes)
+    if args.engine == "duckdb":
+        from .duckdb_engine import combine_duckdb
+
+        unsupported = [
+            option
+            for option, used in [
+                ("--summary", args.summary),
+                ("--checkpoint", args.checkpoint),
+                ("--resume", args.resume),
+                ("--orphans drop", args.orphans != "keep"),
+                ("--optimize_dtypes", args.optimize_dtypes),
+                ("--prefetch_depth", args.prefetch_depth != 2),
+            ]
+            if used
+        ]
+        if unsupported:
+            logger.info(
+                "{} only supported by the pandas engine.".format(
+                    " and ".join(unsupported)
+                    + (" is" if len(unsupported) == 1 else " are")
+                )
+            )
+            logger.info("Exiting application early!")
+            sys.exit()
+
+        combine_duckdb(
+            args.gtfs_dir,
+            args.service_date,
+            args.output_dir,
+            logger,
+            work_dir=args.work_dir,
+            memory_limit=args.memory_limit,
+            time_window=time_window,
+            route_filter=route_filter,
+            sorted_output=args.sorted_output,
+        )
+    else:
+        checkpoint = None
+        if (args.checkpoint or args.resume) and os.path.isdir(args.output_dir):
+            checkpoint = Checkpoint(
+                Path(args.work_dir or args.output_dir) / "combine_checkpoint",
+                {
+                    "gtfs_dir": os.path.abspath(args.gtfs_dir),
+                    "service_date": args.service_date,
+                    "output_dir": os.path.abspath(args.output_dir),
+                    "time_window": time_window,
+                    "route_filter": route_filter,
+                    "orphans": args.orphans,
+                    "optimize_dtypes": args.optimize_dtypes,
+                },
+                args.resume,
+                logger,
+            )
+        feeds = combine(
+            args.gtfs_dir,
+            args.service_date,
+            args.output_dir,
+            logger,
+            prefetch_depth=args.prefetch_depth,
+            time_window=time_window,
+            route_filter=route_filter,
+            memory_limit=args.memory_limit,
+            work_dir=args.work_dir,
+            orphans=args.orphans,
+            optimize=args.optimize_dtypes,
+            checkpoint=checkpoint,
+        )
+
+        if args.summary:
+            from .summary import service_summary
+
+            feeds.summary_tables = service_summary(
+                feeds.trips_df, feeds.stop_times_df, feeds.routes_df, feeds.stops_df
+            )
+        feeds.export_feed(args.sorted_output)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    logger.info("Finished running combine_gtfs_feeds")
+    sys.exit()
+    # print("Finished running combine_gtfs_feeds")
+
+
+def combine(
+    gtfs_dir: str,
+    service_date,
+    output_dir,
+    logger=None,
+    prefetch_depth=2,
+    time_window=None,
+    route_filter=None,
+    memory_limit=None,
+    work_dir=None,
+    orphans="keep",
+    optimize=False,
+    feeds=None,
+    feed_reader=None,
+    checkpoint=None,
+) -> Combined_GTFS:
+    """
+    Combines GTFS feeds from each feed and writes them out to a single feed.
+    The next prefetch_depth feeds are read in the background while the
+    current feed is processed. time_window, a (start_secs, end_secs,
+    time_rule) tuple from get_time_window, limits the trips that are kept
+    and route_filter, from get_route_filter, limits the routes. If the
+    processed feeds exceed memory_limit (e.g. '8GB') they are spilled to
+    work_dir until the combined tables are built. Each feed's references
+    are checked and orphan rows are kept or dropped based on orphans.
+    If optimize is True, dtypes are downcast as each feed is read.
+    feeds limits the feeds combined to a list of feed names and
+    feed_reader replaces read_feed (see prefetch_feeds). If checkpoint,
+    a checkpoint.Checkpoint, is given the result of each stage is saved
+    to it and stages it already holds are loaded instead of run.
+    """
+    if not logger:
+        logger = log_controller.setup_custom_logger("main_logger", output_dir)
+        logger.info("------------------combine_gtfs_feeds Started----------------")
+    output_loc = output_dir
+
+    if not os.path.isdir(output_loc):
+        print("Output Directory path : {} does not exist.".format(output_loc))
+        print("Exiting application early!")
+        sys.exit()
+
+    dir = Path(gtfs_dir)
+    str_service_date = str(service_date)
+    my_date = get_service_date(service_date)
+
+    logger.info("GTFS Directory path is: {}".format(dir))
+    logger.info("Output Directory path is: {}".format(output_loc))
+    logger.info("Service Date is: {}".format(str_service_date))
+    if time_window is not None:
+        logger.info(
+            "Keeping trips that {} between {} and {} seconds after midnight".format(
+                time_window[2], time_window[0], time_window[1]
+            )
+        )
+
+    if not os.path.isdir(dir):
+        logger.info("GTFS Directory path : {} does not exist.".format(dir))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    day_of_week = get_weekday(my_date)
+    feed_list, zipped = get_feed_list(dir)
+    if feeds is not None:
+        missing = [feed for feed in feeds if feed not in feed_list]
+        if missing:
+            logger.info(
+                "Feed(s) {} not found in GTFS Directory path : {}.".format(
+                    ", ".join(missing), dir
+                )
+            )
+            logger.info("Exiting application early!")
+            sys.exit()
+        feed_list = [feed for feed in feed_list if feed in feeds]
+    if memory_limit is not None:
+        memory_limit = parse_memory_limit(memory_limit)
+    accumulator = Feed_Accumulator(
+        Combined_GTFS.file_list, memory_limit, work_dir, logger
+    )
+    integrity_reports = []
+
+    if len(feed_list) == 0:
+        logger.info("There are no GTFS feeds in GTFS Directory path : {}.".format(dir))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    if route_filter is not None:
+        logger.info("Route filter is: {}".format(route_filter))
+
+    signatures = {}
+    if checkpoint is not None:
+        signatures = {feed: feed_signature(dir / feed, zipped) for feed in feed_list}
+    # the merge and validate stages are only reused for the same feeds
+    inputs = [[feed, signatures[feed]] for feed in signatures]
+
+    if checkpoint is not None and checkpoint.done("validate", inputs):
+        return checkpoint.load("validate")
+
+    if checkpoint is not None and checkpoint.done("merge", inputs):
+        combined_feed_dict, integrity_report = checkpoint.load("merge")
+    else:
+        checkpointed = [
+            feed
+            for feed in feed_list
+            if checkpoint is not None and checkpoint.has_feed(feed, signatures[feed])
+        ]
+        feeds_read = prefetch_feeds(
+            dir,
+            [feed for feed in feed_list if feed not in checkpointed],
+            zipped,
+            logger,
+            prefetch_depth,
+            route_filter,
+            optimize,
+            feed_reader,
+        )
+        for feed in feed_list:
+            if feed in checkpointed:
+                tables, report = checkpoint.load_feed(feed)
+            else:
+                _, feed_tables = next(feeds_read)
+                tables, report = process_feed(
+                    feed,
+                    feed_tables,
+                    service_date,
+                    day_of_week,
+                    logger,
+                    time_window,
+                    route_filter,
+                    orphans,
+                )
+                del feed_tables
+                if checkpoint is not None:
+                    checkpoint.save_feed(feed, signatures[feed], tables, report)
+            if tables is None:
+                continue
+            integrity_reports.append(report)
+            # pass data to the accumulator
+            accumulator.add(feed, tables)
+            del tables
+        feeds_read.close()
+
+        combined_feed_dict, integrity_report = merge_feeds(
+            accumulator, integrity_reports, my_date, logger
+        )
+        if checkpoint is not None:
+            checkpoint.save("merge", (combined_feed_dict, integrity_report), inputs)
 
-    return Combined_GTFS(combined_feed_dict, output_dir)
+    feeds = Combined_GTFS(combined_feed_dict, output_dir, integrity_report)
+    if checkpoint is not None:
+        checkpoint.save("validate", feeds, inputs)
+    return feeds
 
 
 if __name__ == "__main__":
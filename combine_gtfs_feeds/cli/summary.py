@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+try:
+    from .run import time_to_seconds
+except Exception:
+    from run import time_to_seconds
+
+# (name, start hour, end hour) of the periods headways are reported for.
+# GTFS times go past 24:00:00 for trips that run after midnight.
+periods = [
+    ("early", 0, 6),
+    ("am_peak", 6, 9),
+    ("midday", 9, 15),
+    ("pm_peak", 15, 18),
+    ("evening", 18, 22),
+    ("night", 22, 48),
+]
+
+
+def format_times(seconds: pd.Series) -> pd.Series:
+    """
+    Converts seconds after midnight to hh:mm:ss, keeping hours past 24.
+    Missing values stay missing.
+    """
+
+    seconds = seconds.astype("Int64")
+    text = (
+        (seconds // 3600).astype(str).str.zfill(2)
+        + ":"
+        + (seconds % 3600 // 60).astype(str).str.zfill(2)
+        + ":"
+        + (seconds % 60).astype(str).str.zfill(2)
+    )
+    return text.where(seconds.notna(), None)
+
+
+def stop_time_seconds(stop_times: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns trip_id, stop_id and the departure time in integer seconds
+    of each stop time with a valid departure time.
+    """
+
+    seconds = time_to_seconds(stop_times["departure_time"])
+    valid = seconds.notna().to_numpy()
+    return pd.DataFrame(
+        {
+            "trip_id": stop_times["trip_id"].to_numpy()[valid],
+            "stop_id": stop_times["stop_id"].to_numpy()[valid],
+            "seconds": seconds.to_numpy()[valid].astype(np.int64),
+        }
+    )
+
+
+def route_stats(
+    trips: pd.DataFrame, routes: pd.DataFrame, departures: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Returns the number of trips, the first and last trip start and the
+    mean headway in minutes in each period of each route. Headways are
+    the gaps between consecutive trip starts in the same direction and
+    period.
+    """
+
+    starts = departures.groupby("trip_id", sort=False)["seconds"].min()
+    group = ["route_id"] + (["direction_id"] if "direction_id" in trips.columns else [])
+    df = trips[["trip_id"] + group].merge(
+        starts.rename("start"), left_on="trip_id", right_index=True
+    )
+    df["period"] = pd.cut(
+        df["start"],
+        bins=[start * 3600 for _, start, _ in periods] + [periods[-1][2] * 3600],
+        labels=[name for name, _, _ in periods],
+        right=False,
+    )
+    df = df.sort_values(group + ["start"])
+    df["gap"] = df.groupby(group + ["period"], dropna=False, observed=True)[
+        "start"
+    ].diff()
+
+    stats = df.groupby("route_id").agg(
+        trips=("trip_id", "size"),
+        first_trip_start=("start", "min"),
+        last_trip_start=("start", "max"),
+    )
+    stats["first_trip_start"] = format_times(stats["first_trip_start"])
+    stats["last_trip_start"] = format_times(stats["last_trip_start"])
+    headways = (
+        df.dropna(subset=["gap"])
+        .groupby(["route_id", "period"], observed=False)["gap"]
+        .mean()
+        .unstack("period")
+        .reindex(columns=[name for name, _, _ in periods])
+        .div(60)
+        .round(1)
+    )
+    headways.columns = [f"headway_{name}" for name in headways.columns]
+    stats = stats.join(headways)
+
+    route_columns = [
+        col for col in ["route_short_name", "route_type"] if col in routes.columns
+    ]
+    stats = routes[["route_id"] + route_columns].merge(
+        stats, left_on="route_id", right_index=True
+    )
+    return stats.sort_values("route_id").reset_index(drop=True)
+
+
+def stop_stats(
+    trips: pd.DataFrame, stops: pd.DataFrame, departures: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Returns the number of trips and routes serving each stop and the
+    first and last departure from it.
+    """
+
+    df = departures.merge(trips[["trip_id", "route_id"]], on="trip_id")
+    # a loop trip can serve a stop more than once
+    stats = df.groupby("stop_id").agg(
+        trips=("trip_id", "nunique"),
+        routes=("route_id", "nunique"),
+        first_departure=("seconds", "min"),
+        last_departure=("seconds", "max"),
+    )
+    stats["first_departure"] = format_times(stats["first_departure"])
+    stats["last_departure"] = format_times(stats["last_departure"])
+
+    stop_columns = [col for col in ["stop_name"] if col in stops.columns]
+    stats = stops[["stop_id"] + stop_columns].merge(
+        stats, left_on="stop_id", right_index=True
+    )
+    return stats.sort_values("stop_id").reset_index(drop=True)
+
+
+def service_summary(
+    trips: pd.DataFrame,
+    stop_times: pd.DataFrame,
+    routes: pd.DataFrame,
+    stops: pd.DataFrame,
+) -> dict:
+    """
+    Returns the route_stats and stop_stats tables of a combined feed.
+    Departure times are converted to seconds once and shared.
+    """
+
+    departures = stop_time_seconds(stop_times)
+    return {
+        "route_stats": route_stats(trips, routes, departures),
+        "stop_stats": stop_stats(trips, stops, departures),
+    }
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import combine_gtfs_feeds.cli.log_controller as log_controller  # type: ignore
+
+try:
+    from .accumulator import Feed_Accumulator, parse_memory_limit
+    from .run import (
+        Combined_GTFS,
+        get_feed_list,
+        get_route_filter,
+        get_service_date,
+        get_time_window,
+        get_weekday,
+        merge_feeds,
+        prefetch_feeds,
+        process_feed,
+    )
+    from .summary import service_summary
+except Exception:
+    from accumulator import Feed_Accumulator, parse_memory_limit
+    from run import (
+        Combined_GTFS,
+        get_feed_list,
+        get_route_filter,
+        get_service_date,
+        get_time_window,
+        get_weekday,
+        merge_feeds,
+        prefetch_feeds,
+        process_feed,
+    )
+    from summary import service_summary
+
+import argparse
+import hashlib
+import os as os
+import sys
+import time
+from pathlib import Path
+
+
+class Feed_Fingerprints:
+    """
+    Content fingerprints of the feeds in a directory, found by polling
+    so they work on network file systems. A file is only hashed again
+    if its size or modification time changed since it was last hashed.
+    """
+
+    def __init__(self, block_size=1024**2):
+        self.block_size = block_size
+        # path -> ((size, mtime_ns), digest)
+        self.hashes = {}
+
+    def file_hash(self, path: Path) -> str:
+        """
+        Returns the hash of a file's contents.
+        """
+
+        stat = path.stat()
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(self.block_size), b""):
+                digest.update(block)
+        self.hashes[path] = (signature, digest.hexdigest())
+        return digest.hexdigest()
+
+    def feed_hash(self, path: Path, is_zipped: bool) -> str:
+        """
+        Returns the fingerprint of a feed, the hash of its zip file or
+        of the names and hashes of the files in its folder.
+        """
+
+        if is_zipped:
+            return self.file_hash(path.with_suffix(".zip"))
+        digest = hashlib.blake2b(digest_size=16)
+        for file_path in sorted(path.iterdir()):
+            if file_path.is_file():
+                digest.update(file_path.name.encode())
+                digest.update(self.file_hash(file_path).encode())
+        return digest.hexdigest()
+
+    def scan(self, gtfs_dir: Path) -> tuple[dict, bool]:
+        """
+        Returns a dictionary of feed name to fingerprint for the feeds
+        in gtfs_dir, in get_feed_list order, and whether they are zipped.
+        """
+
+        feed_list, zipped = get_feed_list(gtfs_dir)
+        fingerprints = {
+            feed: self.feed_hash(gtfs_dir / feed, zipped) for feed in feed_list
+        }
+        # forget files that are gone
+        paths = set(gtfs_dir.glob("*.zip")) | set(gtfs_dir.glob("*/*"))
+        self.hashes = {
+            path: value for path, value in self.hashes.items() if path in paths
+        }
+        return fingerprints, zipped
+
+
+def log_changes(previous: dict, current: dict, logger) -> None:
+    for feed in current:
+        if feed not in previous:
+            logger.info(f"Feed {feed} was added")
+        elif previous[feed] != current[feed]:
+            logger.info(f"Feed {feed} changed")
+    for feed in previous:
+        if feed not in current:
+            logger.info(f"Feed {feed} was removed")
+
+
+def rebuild(
+    args: argparse.Namespace,
+    fingerprints: dict,
+    zipped: bool,
+    processed: dict,
+    logger,
+) -> None:
+    """
+    Processes the feeds whose fingerprint is not in processed, a
+    dictionary of feed name to (fingerprint, tables, integrity report)
+    kept between builds, then combines all feeds and exports them.
+    """
+
+    for feed in list(processed):
+        if feed not in fingerprints:
+            del processed[feed]
+    changed = [
+        feed
+        for feed, fingerprint in fingerprints.items()
+        if feed not in processed or processed[feed][0] != fingerprint
+    ]
+    logger.info(
+        "Rebuilding, processing {} of {} feeds {}".format(
+            len(changed), len(fingerprints), " ".join(changed)
+        ).rstrip()
+    )
+
+    my_date = get_service_date(args.service_date)
+    time_window = get_time_window(args.start_time, args.end_time, args.time_rule)
+    route_filter = get_route_filter(args.agencies, args.route_types, args.routes)
+    for feed, feed_tables in prefetch_feeds(
+        Path(args.gtfs_dir),
+        changed,
+        zipped,
+        logger,
+        args.prefetch_depth,
+        route_filter,
+        args.optimize_dtypes,
+    ):
+        tables, report = process_feed(
+            feed,
+            feed_tables,
+            args.service_date,
+            get_weekday(my_date),
+            logger,
+            time_window,
+            route_filter,
+            args.orphans,
+        )
+        del feed_tables
+        processed[feed] = (fingerprints[feed], tables, report)
+
+    memory_limit = None
+    if args.memory_limit is not None:
+        memory_limit = parse_memory_limit(args.memory_limit)
+    accumulator = Feed_Accumulator(
+        Combined_GTFS.file_list, memory_limit, args.work_dir, logger
+    )
+    integrity_reports = []
+    for feed in fingerprints:
+        _, tables, report = processed[feed]
+        if tables is None:
+            continue
+        # the accumulator takes the tables out of the dictionary it is
+        # given, the processed tables are kept for the next build
+        accumulator.add(feed, dict(tables))
+        integrity_reports.append(report)
+
+    combined_feed_dict, integrity_report = merge_feeds(
+        accumulator, integrity_reports, my_date, logger
+    )
+    feeds = Combined_GTFS(combined_feed_dict, args.output_dir, integrity_report)
+    if args.summary:
+        feeds.summary_tables = service_summary(
+            feeds.trips_df, feeds.stop_times_df, feeds.routes_df, feeds.stops_df
+        )
+    feeds.export_feed(args.sorted_output)
+
+
+def watch(args: argparse.Namespace) -> None:
+    """
+    Implements the 'watch' sub-command, which combines the feeds in
+    gtfs_dir and combines them again when feeds are added, changed or
+    removed. Changes are found by polling every interval seconds and
+    a rebuild starts once no feed has changed for debounce seconds.
+    Only the feeds that changed are read and processed again.
+    """
+
+    logger = log_controller.setup_custom_logger("main_logger", args.output_dir)
+    logger.info("------------------combine_gtfs_feeds watch Started----------------")
+
+    if args.engine != "pandas":
+        logger.info("watch only supports the pandas engine.")
+        logger.info("Exiting application early!")
+        sys.exit()
+    for path in [args.gtfs_dir, args.output_dir]:
+        if not os.path.isdir(path):
+            logger.info("Directory path : {} does not exist.".format(path))
+            logger.info("Exiting application early!")
+            sys.exit()
+
+    try:
+        get_time_window(args.start_time, args.end_time, args.time_rule)
+    except ValueError as e:
+        logger.info(str(e))
+        logger.info("Exiting application early!")
+        sys.exit()
+
+    gtfs_dir = Path(args.gtfs_dir)
+    logger.info(
+        f"Watching {gtfs_dir} every {args.interval} seconds, rebuilding"
+        f" {args.output_dir} {args.debounce} seconds after the last change"
+    )
+
+    fingerprints = Feed_Fingerprints()
+    processed = {}
+    processed_zipped = None
+    seen = {}
+    built = None
+    changed_at = None
+    try:
+        while True:
+            try:
+                current, zipped = fingerprints.scan(gtfs_dir)
+            except OSError as e:
+                # a feed was being written or removed while it was read
+                logger.info(f"Warning! Could not read {gtfs_dir}: {e}")
+                time.sleep(args.interval)
+                continue
+
+            if current != seen:
+                log_changes(seen, current, logger)
+                seen = current
+                changed_at = time.monotonic()
+            elif (
+                changed_at is not None
+                and time.monotonic() - changed_at >= args.debounce
+            ):
+                changed_at = None
+                if current != built and len(current) > 0:
+                    if zipped != processed_zipped:
+                        processed.clear()
+                        processed_zipped = zipped
+                    start = time.perf_counter()
+                    try:
+                        rebuild(args, current, zipped, processed, logger)
+                        logger.info(
+                            "Finished rebuilding in {:.1f} seconds".format(
+                                time.perf_counter() - start
+                            )
+                        )
+                    except (SystemExit, Exception) as e:
+                        logger.info(
+                            f"Rebuild failed, keeping the previous output: {e!r}"
+                        )
+                    # a failed build is retried when the feeds change again
+                    built = current
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching")